@@ -0,0 +1,26 @@
+"""trigram index for product page_url lookups
+
+Revision ID: 0011_products_page_url_trgm
+Revises: 0010_admin_media_notes
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0011_products_page_url_trgm"
+down_revision = "0010_admin_media_notes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_products_page_url_trgm "
+        "ON products USING gin (page_url gin_trgm_ops)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_products_page_url_trgm")
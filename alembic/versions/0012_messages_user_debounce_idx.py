@@ -0,0 +1,26 @@
+"""partial index for debounce lookups on user messages
+
+Revision ID: 0012_messages_user_debounce_idx
+Revises: 0011_products_page_url_trgm
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0012_messages_user_debounce_idx"
+down_revision = "0011_products_page_url_trgm"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation_user_id "
+        "ON messages (conversation_id, id) "
+        "WHERE role = 'user' AND type <> 'read'"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_messages_conversation_user_id")
@@ -0,0 +1,33 @@
+"""indexed conversation_id column on app_logs
+
+Revision ID: 0013_app_logs_conversation_id
+Revises: 0012_messages_user_debounce_idx
+Create Date: 2026-10-17
+"""
+from __future__ import annotations
+
+from alembic import op
+
+revision = "0013_app_logs_conversation_id"
+down_revision = "0012_messages_user_debounce_idx"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE app_logs ADD COLUMN IF NOT EXISTS conversation_id INTEGER")
+    op.execute(
+        "UPDATE app_logs SET conversation_id = (data->>'conversation_id')::int "
+        "WHERE event_type = 'assistant_response' "
+        "AND conversation_id IS NULL "
+        "AND data->>'conversation_id' ~ '^[0-9]+$'"
+    )
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_app_logs_conv_event "
+        "ON app_logs (conversation_id, event_type, created_at DESC)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_app_logs_conv_event")
+    op.drop_column("app_logs", "conversation_id")
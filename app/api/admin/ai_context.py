@@ -99,7 +99,7 @@ async def get_ai_context(
         result = await session.execute(
             select(Message)
             .where(Message.conversation_id == conversation.id)
-            .order_by(Message.created_at.desc())
+            .order_by(Message.created_at.desc(), Message.id.desc())
             .limit(10)
         )
         recent_messages = list(reversed(result.scalars().all()))
@@ -218,7 +218,7 @@ async def get_agent_trace_by_conversation(
     message_result = await session.execute(
         select(Message)
         .where(Message.conversation_id == conversation.id)
-        .order_by(Message.created_at.desc())
+        .order_by(Message.created_at.desc(), Message.id.desc())
         .limit(message_limit)
     )
     messages = list(reversed(message_result.scalars().all()))
@@ -310,7 +310,7 @@ async def simulate_reply(
     result = await session.execute(
         select(Message)
         .where(Message.conversation_id == conversation.id)
-        .order_by(Message.created_at.desc())
+        .order_by(Message.created_at.desc(), Message.id.desc())
         .limit(12)
     )
     history = list(reversed(result.scalars().all()))
@@ -50,6 +50,7 @@ from app.services.audit import record_audit
 from app.services.llm_clients import LLMError, generate_reply
 from app.services.llm_router import choose_provider
 from app.services.product_matcher import match_products
+from app.services.product_presenter import leading_image_urls
 from app.services.processor import generate_with_fallback, record_usage
 from app.services.prompts import load_prompt
 from app.utils.time import utc_now
@@ -159,14 +160,9 @@ def _build_product_context(products: list[Product]) -> str:
             summary = " ".join(product.description.split())
             if summary:
                 parts.append(f"توضیحات: {summary[:220]}")
-        if isinstance(product.images, list):
-            image_urls = [
-                str(item).strip()
-                for item in product.images
-                if isinstance(item, str) and str(item).strip()
-            ]
-            if image_urls:
-                parts.append(f"عکس‌ها: {', '.join(image_urls[:2])}")
+        image_urls = leading_image_urls(product, 2)
+        if image_urls:
+            parts.append(f"عکس‌ها: {', '.join(image_urls)}")
         if product.page_url:
             parts.append(f"لینک: {product.page_url}")
         lines.append(" | ".join(parts))
@@ -343,7 +339,7 @@ async def _build_snapshot(session: AsyncSession) -> str:
         select(Message, Conversation, User)
         .join(Conversation, Message.conversation_id == Conversation.id)
         .join(User, Conversation.user_id == User.id)
-        .order_by(Message.created_at.desc())
+        .order_by(Message.created_at.desc(), Message.id.desc())
         .limit(80)
     )
 
@@ -1470,14 +1466,11 @@ async def chat_with_assistant(
         truncated=truncated,
     )
     session.add(assistant_message)
-    await session.commit()
-
     if usage:
-        await record_usage(session, usage, provider_used)
-
+        await record_usage(session, usage, provider_used, commit=False)
     if not conversation.title:
         conversation.title = last_user_text[:80]
-        await session.commit()
+    await session.commit()
 
     return AssistantChatResponse(
         conversation_id=conversation.id,
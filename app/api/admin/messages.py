@@ -78,10 +78,11 @@ async def list_messages(
             pass
 
     sort_col = getattr(Message, sort, Message.created_at)
+    # Rows written in one transaction share created_at; id keeps send order.
     if order.lower() == "desc":
-        query = query.order_by(sort_col.desc())
+        query = query.order_by(sort_col.desc(), Message.id.desc())
     else:
-        query = query.order_by(sort_col.asc())
+        query = query.order_by(sort_col.asc(), Message.id.asc())
 
     total = await session.scalar(select(func.count()).select_from(query.subquery()))
     result = await session.execute(query.offset(skip).limit(limit))
@@ -115,6 +115,7 @@ class Settings(BaseSettings):
     PRODUCT_CATALOG_TOP_CATEGORIES: int = 5
     PRODUCT_CONTINUE_TTL_SEC: int = 600
     RESPONSE_LOG_CONTEXT_LIMIT: int = 3
+    PROMPT_CONTEXT_TTL_SEC: int = 30
     LOOP_BREAKER_THRESHOLD: int = 2
     LOOP_AUTO_ESCALATE_ENABLED: bool = True
     LOOP_ESCALATION_THRESHOLD: int = 3
@@ -124,6 +125,8 @@ class Settings(BaseSettings):
     LLM_REQUIRE_FIELDS_ON_LOW_CONF: bool = True
     LLM_STRICT_PRICE_GROUNDING: bool = True
     USER_MEMORY_ITEMS: int = 8
+    USER_ENRICH_TTL_SEC: int = 3600
+    USER_ENRICH_CACHE_MAX: int = 10000
     BEHAVIOR_HISTORY_LIMIT: int = 200
     BEHAVIOR_RECENT_LIMIT: int = 5
     BEHAVIOR_MIN_CONFIDENCE: float = 0.35
@@ -139,6 +142,9 @@ class Settings(BaseSettings):
     FOLLOWUP_POLL_SEC: int = 60
     FOLLOWUP_MESSAGE: str = "اگر سوال یا خریدی داشتید، من در خدمتم."
 
+    EVENT_SINK_BATCH_SIZE: int = 64
+    EVENT_SINK_QUEUE_MAX: int = 10000
+
     VIP_SCORE_THRESHOLD: int = 5
     CROSS_SELL_ENABLED: bool = True
     CROSS_SELL_COOLDOWN_MIN: int = 240
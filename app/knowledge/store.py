@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from typing import Iterable
 
 STORE_KNOWLEDGE = {
@@ -92,6 +93,8 @@ def _bulletize(items: Iterable[str]) -> str:
     return "\n".join(f"- {item}" for item in items)
 
 
+# STORE_KNOWLEDGE is static, so the prompt text is rendered once like load_prompt's files.
+@lru_cache(maxsize=1)
 def get_store_knowledge_text() -> str:
     categories = "، ".join(STORE_KNOWLEDGE["categories"])
     strengths = "، ".join(STORE_KNOWLEDGE["strengths"])
@@ -15,8 +15,10 @@ from app.api.service import InvalidApiTokenError, router as service_router
 from app.core.config import settings
 from app.core.database import init_db
 from app.core.logging import setup_logging
+from app.services.app_log_store import event_sink_worker
 from app.services.followups import followup_worker
 from app.services.processor import handle_webhook
+from app.services.sender import close_sender
 from app.utils.security import verify_signature
 
 app = FastAPI(title="Instagram DM Bot")
@@ -72,6 +74,10 @@ async def on_startup() -> None:
     app.state.followup_task = asyncio.create_task(
         followup_worker(app.state.followup_stop)
     )
+    app.state.event_sink_stop = asyncio.Event()
+    app.state.event_sink_task = asyncio.create_task(
+        event_sink_worker(app.state.event_sink_stop)
+    )
 
 
 @app.on_event("shutdown")
@@ -86,6 +92,17 @@ async def on_shutdown() -> None:
             await task
         except asyncio.CancelledError:
             pass
+    sink_stop = getattr(app.state, "event_sink_stop", None)
+    sink_task = getattr(app.state, "event_sink_task", None)
+    if sink_stop:
+        sink_stop.set()
+    if sink_task:
+        # Let the sink write what is still queued before the process exits.
+        try:
+            await asyncio.wait_for(sink_task, timeout=5)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+    await close_sender()
 
 
 @app.get("/health")
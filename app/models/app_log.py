@@ -15,6 +15,7 @@ class AppLog(Base):
     event_type: Mapped[str] = mapped_column(String(100))
     message: Mapped[str | None] = mapped_column(Text)
     data: Mapped[dict | None] = mapped_column(JSONB)
+    conversation_id: Mapped[int | None] = mapped_column(Integer)
     created_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now()
     )
@@ -16,6 +16,7 @@ async def create_admin_media_note(
     message_id: int | None = None,
     tag: str | None = None,
     category: str | None = None,
+    commit: bool = True,
 ) -> AdminMediaNote:
     note = AdminMediaNote(
         conversation_id=conversation_id,
@@ -25,7 +26,8 @@ async def create_admin_media_note(
         category=category,
     )
     session.add(note)
-    await session.commit()
+    if commit:
+        await session.commit()
     return note
 
 
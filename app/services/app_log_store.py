@@ -1,9 +1,35 @@
 from __future__ import annotations
 
+import asyncio
+from typing import Any
+
+from sqlalchemy import event, insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, SessionTransaction
+import structlog
 
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
 from app.models.app_log import AppLog
 
+logger = structlog.get_logger(__name__)
+
+_PENDING_LOGS_KEY = "pending_app_logs"
+_EVENT_QUEUE: asyncio.Queue[dict[str, Any]] = asyncio.Queue(
+    maxsize=settings.EVENT_SINK_QUEUE_MAX
+)
+
+
+def _conversation_id(data: dict | None) -> int | None:
+    # Mirrored into an indexed column so per-conversation lookups skip the
+    # JSONB extract and cast.
+    if not data:
+        return None
+    value = data.get("conversation_id")
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
 
 async def log_event(
     session: AsyncSession,
@@ -18,7 +44,72 @@ async def log_event(
         event_type=event_type,
         message=message,
         data=data,
+        conversation_id=_conversation_id(data),
     )
-    session.add(log)
+    # Deferred logs stay out of autoflushes and go out as one batch at commit.
+    session.info.setdefault(_PENDING_LOGS_KEY, []).append(log)
     if commit:
         await session.commit()
+
+
+def emit_event(
+    level: str,
+    event_type: str,
+    message: str | None = None,
+    data: dict | None = None,
+) -> None:
+    # For diagnostics nobody reads back within the request; event_sink_worker
+    # writes them in batches off the request path.
+    try:
+        _EVENT_QUEUE.put_nowait(
+            {"level": level, "event_type": event_type, "message": message, "data": data}
+        )
+    except asyncio.QueueFull:
+        logger.warning("event_sink_full", event_type=event_type)
+
+
+async def event_sink_worker(stop_event: asyncio.Event) -> None:
+    while not stop_event.is_set():
+        try:
+            row = await asyncio.wait_for(_EVENT_QUEUE.get(), timeout=1.0)
+        except asyncio.TimeoutError:
+            continue
+        rows = [row]
+        while len(rows) < settings.EVENT_SINK_BATCH_SIZE and not _EVENT_QUEUE.empty():
+            rows.append(_EVENT_QUEUE.get_nowait())
+        await _write_events(rows)
+    await _drain_events()
+
+
+async def _drain_events() -> None:
+    rows: list[dict[str, Any]] = []
+    while not _EVENT_QUEUE.empty():
+        rows.append(_EVENT_QUEUE.get_nowait())
+    if rows:
+        await _write_events(rows)
+
+
+async def _write_events(rows: list[dict[str, Any]]) -> None:
+    try:
+        async with AsyncSessionLocal() as session:
+            # Plain executemany: nothing reads these rows back, so skip building
+            # ORM objects and fetching their ids.
+            await session.execute(
+                insert(AppLog),
+                [{**row, "conversation_id": _conversation_id(row["data"])} for row in rows],
+            )
+            await session.commit()
+    except Exception as exc:
+        logger.error("errors", stage="event_sink", error=str(exc), dropped=len(rows))
+
+
+@event.listens_for(Session, "before_commit")
+def _add_pending_logs(session: Session) -> None:
+    pending = session.info.pop(_PENDING_LOGS_KEY, None)
+    if pending:
+        session.add_all(pending)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _drop_pending_logs(session: Session, previous_transaction: SessionTransaction) -> None:
+    session.info.pop(_PENDING_LOGS_KEY, None)
@@ -22,33 +22,30 @@ def _format_section(title: str, body: str | None) -> str | None:
     return f"[{title}]\n{body.strip()}"
 
 
+def _campaign_line(campaign: Campaign) -> str:
+    parts = [campaign.title, campaign.body]
+    if campaign.discount_code:
+        parts.append(f"کد تخفیف: {campaign.discount_code}")
+    if campaign.link:
+        parts.append(f"لینک: {campaign.link}")
+    return "- " + " | ".join(part for part in parts if part)
+
+
 def format_campaigns(campaigns: list[Campaign]) -> str | None:
     if not campaigns:
         return None
-    lines = []
-    for campaign in campaigns:
-        parts = [campaign.title, campaign.body]
-        if campaign.discount_code:
-            parts.append(f"کد تخفیف: {campaign.discount_code}")
-        if campaign.link:
-            parts.append(f"لینک: {campaign.link}")
-        lines.append(" | ".join(part for part in parts if part))
-    if not lines:
-        return None
-    return "\n".join(f"- {line}" for line in lines)
+    return "\n".join(map(_campaign_line, campaigns))
 
 
 def format_faqs(faqs: list[Faq]) -> str | None:
     if not faqs:
         return None
-    lines = [
+    text = "\n".join(
         f"Q: {faq.question}\nA: {faq.answer}"
         for faq in faqs
         if faq.question and faq.answer
-    ]
-    if not lines:
-        return None
-    return "\n".join(lines)
+    )
+    return text or None
 
 
 def format_recent_messages(history: list[Message], limit: int = 6) -> str | None:
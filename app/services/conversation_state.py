@@ -28,6 +28,7 @@ INTENT_PRODUCT_SELECTED = "product_selected"
 INTENT_SUPPORT = "support"
 INTENT_ORDER = "order_flow"
 INTENT_UNKNOWN = "unknown"
+_PRODUCT_LOCKED_INTENTS = frozenset({INTENT_PRODUCT_SELECTED, INTENT_ORDER})
 
 CATEGORY_SHOES = "shoes"
 CATEGORY_APPAREL = "apparel"
@@ -120,12 +121,14 @@ async def update_state(
     loop_counter: int | None = None,
     increment_loop: bool = False,
     reset_loop: bool = False,
+    commit: bool = True,
 ) -> ConversationState:
     state = state or await get_or_create_state(session, conversation_id)
+    before = _state_fields(state)
     effective_selected = selected_product
     if preserve_selected_product and selected_product is None:
         effective_selected = state.selected_product
-    if effective_selected and intent not in {INTENT_PRODUCT_SELECTED, INTENT_ORDER}:
+    if effective_selected and intent not in _PRODUCT_LOCKED_INTENTS:
         intent = INTENT_PRODUCT_SELECTED
     state.intent = intent
     state.category = category
@@ -144,11 +147,29 @@ async def update_state(
         state.loop_counter = (state.loop_counter or 0) + 1
     elif loop_counter is not None:
         state.loop_counter = loop_counter
-    state.updated_at = utc_now()
-    await session.commit()
+    # Repeated touches within one turn usually write the same values; leaving
+    # updated_at alone then keeps the row clean so no UPDATE is flushed.
+    if _state_fields(state) != before:
+        state.updated_at = utc_now()
+    if commit:
+        await session.commit()
     return state
 
 
+def _state_fields(state: ConversationState) -> tuple[Any, ...]:
+    return (
+        state.intent,
+        state.category,
+        state.slots_required,
+        state.slots_filled,
+        state.last_user_question,
+        state.selected_product,
+        state.last_user_message_id,
+        state.last_handler_used,
+        state.loop_counter,
+    )
+
+
 async def record_bot_action(
     session: AsyncSession,
     conversation_id: int,
@@ -156,8 +177,10 @@ async def record_bot_action(
     answer: str | None,
     *,
     handler_used: str | None = None,
+    state: ConversationState | None = None,
+    commit: bool = True,
 ) -> None:
-    state = await get_or_create_state(session, conversation_id)
+    state = state or await get_or_create_state(session, conversation_id)
     state.last_bot_action = intent
     answers = (
         state.last_bot_answer_by_intent
@@ -170,7 +193,8 @@ async def record_bot_action(
     if handler_used is not None:
         state.last_handler_used = handler_used
     state.updated_at = utc_now()
-    await session.commit()
+    if commit:
+        await session.commit()
 
 
 def build_state_payload(state: ConversationState | None) -> dict[str, Any] | None:
@@ -16,7 +16,7 @@ from app.models.followup_task import FollowupTask
 from app.models.message import Message
 from app.models.user import User
 from app.services.app_log_store import log_event
-from app.services.sender import Sender, SenderError
+from app.services.sender import SenderError, get_sender
 from app.utils.time import utc_now
 
 
@@ -121,7 +121,6 @@ async def cancel_followups_for_conversation(
     for task in tasks:
         task.status = "cancelled"
         task.reason = reason
-    await session.commit()
     await log_event(
         session,
         level="info",
@@ -131,7 +130,9 @@ async def cancel_followups_for_conversation(
             "count": len(tasks),
             "reason": reason,
         },
+        commit=False,
     )
+    await session.commit()
     return len(tasks)
 
 
@@ -157,10 +158,10 @@ async def _send_followup(
         task.status = "skipped"
         await session.commit()
         return False
-    sender = Sender()
+    sender = get_sender()
     try:
         response = await sender.send_text(user.external_id, message_text)
-        message_id = response.get("message_id") if isinstance(response, dict) else None
+        message_id = response.get("message_id")
     except SenderError as exc:
         task.status = "failed"
         await session.commit()
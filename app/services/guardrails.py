@@ -3,6 +3,7 @@ from __future__ import annotations
 import json
 import re
 from datetime import datetime
+from functools import lru_cache
 from typing import Iterable
 from urllib.parse import urlparse
 
@@ -20,6 +21,7 @@ from app.knowledge.store import (
     get_website_url,
 )
 from app.schemas.send import Button, OutboundPlan, QuickReplyOption, TemplateElement
+from app.utils.keywords import KeywordClassifier
 
 FALLBACK_GENERAL = "سلام! برای راهنمایی دقیق‌تر، بگید دنبال چه محصول/دسته‌ای هستید یا بودجه‌تون چقدره؟"
 FALLBACK_MEDIA = "پیام رسانه‌ای دریافت شد. لطفاً توضیح کوتاه متنی بفرستید تا سریع‌تر راهنمایی کنیم."
@@ -486,69 +488,87 @@ def _is_url_only(text: str) -> bool:
     return not stripped.strip()
 
 
-def _contains_any(text: str, keywords: set[str]) -> bool:
-    normalized = _normalize_text(text)
-    return any(_normalize_text(keyword) in normalized for keyword in keywords)
+_KEYWORD_CLASSIFIER = KeywordClassifier(
+    {
+        "greeting": GREETING_KEYWORDS,
+        "address": ADDRESS_KEYWORDS,
+        "product_address": PRODUCT_ADDRESS_KEYWORDS,
+        "hours": HOURS_KEYWORDS,
+        "phone": PHONE_KEYWORDS,
+        "contact": CONTACT_KEYWORDS,
+        "website": WEBSITE_KEYWORDS,
+        "trust": TRUST_KEYWORDS,
+        "price": PRICE_KEYWORDS,
+        "product_intent": PRODUCT_INTENT_KEYWORDS,
+        "continue": CONTINUE_KEYWORDS,
+        "angry": ANGRY_KEYWORDS,
+        "negative_feedback": NEGATIVE_FEEDBACK_KEYWORDS,
+        "thanks": THANKS_KEYWORDS,
+        "goodbye": GOODBYE_KEYWORDS,
+        "decline": DECLINE_KEYWORDS,
+        "repeat": REPEAT_KEYWORDS,
+    },
+    normalize=_normalize_text,
+)
+STORE_INFO_TAGS = frozenset({"contact", "website", "address", "hours", "phone", "trust"})
+
+
+@lru_cache(maxsize=512)
+def keyword_hits(text: str | None) -> frozenset[str]:
+    return _KEYWORD_CLASSIFIER.classify(text)
 
 
 def is_greeting(text: str) -> bool:
-    return _contains_any(text, GREETING_KEYWORDS)
+    return "greeting" in keyword_hits(text)
 
 
 def needs_product_details(text: str) -> bool:
-    if _contains_any(text, CONTACT_KEYWORDS | WEBSITE_KEYWORDS | ADDRESS_KEYWORDS | HOURS_KEYWORDS | PHONE_KEYWORDS | TRUST_KEYWORDS):
+    hits = keyword_hits(text)
+    if hits & STORE_INFO_TAGS:
         return False
-    return _contains_any(text, PRICE_KEYWORDS)
+    return "price" in hits
 
 
 def wants_product_intent(text: str) -> bool:
-    if _contains_any(text, CONTACT_KEYWORDS | WEBSITE_KEYWORDS | ADDRESS_KEYWORDS | HOURS_KEYWORDS | PHONE_KEYWORDS | TRUST_KEYWORDS):
+    hits = keyword_hits(text)
+    if hits & STORE_INFO_TAGS:
         return False
-    if _contains_any(text, PRICE_KEYWORDS):
-        return True
-    return _contains_any(text, PRODUCT_INTENT_KEYWORDS)
+    return "price" in hits or "product_intent" in hits
 
 
 def is_angry(text: str) -> bool:
-    return _contains_any(text, ANGRY_KEYWORDS)
+    return "angry" in keyword_hits(text)
 
 
 def wants_website(text: str) -> bool:
-    return _contains_any(text, WEBSITE_KEYWORDS)
+    return "website" in keyword_hits(text)
 
 
 def wants_address(text: str) -> bool:
-    return _contains_any(text, ADDRESS_KEYWORDS)
+    return "address" in keyword_hits(text)
 
 
 def wants_hours(text: str) -> bool:
-    return _contains_any(text, HOURS_KEYWORDS)
+    return "hours" in keyword_hits(text)
 
 
 def wants_phone(text: str) -> bool:
-    return _contains_any(text, PHONE_KEYWORDS)
+    return "phone" in keyword_hits(text)
 
 
 def wants_contact(text: str) -> bool:
-    return _contains_any(text, CONTACT_KEYWORDS)
+    return "contact" in keyword_hits(text)
 
 
 def wants_more_products(text: str) -> bool:
-    if _contains_any(
-        text,
-        CONTACT_KEYWORDS
-        | WEBSITE_KEYWORDS
-        | ADDRESS_KEYWORDS
-        | HOURS_KEYWORDS
-        | PHONE_KEYWORDS
-        | TRUST_KEYWORDS,
-    ):
+    hits = keyword_hits(text)
+    if hits & STORE_INFO_TAGS:
         return False
-    return _contains_any(text, CONTINUE_KEYWORDS)
+    return "continue" in hits
 
 
 def wants_repeat(text: str) -> bool:
-    return _contains_any(text, REPEAT_KEYWORDS)
+    return "repeat" in keyword_hits(text)
 
 
 def wants_product_link(text: str) -> bool:
@@ -563,16 +583,12 @@ def wants_product_link(text: str) -> bool:
 
 
 def wants_product_address(text: str) -> bool:
-    normalized = _normalize_text(text)
-    if not normalized:
-        return False
-    if not _contains_any(normalized, ADDRESS_KEYWORDS):
-        return False
-    return _contains_any(normalized, PRODUCT_ADDRESS_KEYWORDS)
+    hits = keyword_hits(text)
+    return "address" in hits and "product_address" in hits
 
 
 def is_negative_feedback(text: str) -> bool:
-    return _contains_any(text, NEGATIVE_FEEDBACK_KEYWORDS)
+    return "negative_feedback" in keyword_hits(text)
 
 
 def format_outbound_text(text: str | None) -> str:
@@ -607,19 +623,19 @@ def is_purchase_confirmation(text: str | None) -> bool:
 
 
 def wants_trust(text: str) -> bool:
-    return _contains_any(text, TRUST_KEYWORDS)
+    return "trust" in keyword_hits(text)
 
 
 def is_thanks(text: str) -> bool:
-    return _contains_any(text, THANKS_KEYWORDS)
+    return "thanks" in keyword_hits(text)
 
 
 def is_goodbye(text: str) -> bool:
-    return _contains_any(text, GOODBYE_KEYWORDS)
+    return "goodbye" in keyword_hits(text)
 
 
 def is_decline(text: str) -> bool:
-    return _contains_any(text, DECLINE_KEYWORDS)
+    return "decline" in keyword_hits(text)
 
 
 def build_quick_reply_plan() -> OutboundPlan:
@@ -917,16 +933,16 @@ def _limit_emojis(text: str, max_emojis: int) -> str:
     return "".join(output)
 
 
-def _looks_like_generic_slot_prompt(text: str) -> bool:
-    normalized = _normalize_text(text)
+# The reply checks below take text already passed through _normalize_text, so
+# validate_reply_or_rewrite normalizes the reply once for all of them.
+def _looks_like_generic_slot_prompt(normalized: str) -> bool:
     if not normalized:
         return False
     hits = sum(1 for keyword in GENERIC_SLOT_KEYWORDS if keyword in normalized)
     return hits >= 2
 
 
-def _looks_like_product_prompt(text: str) -> bool:
-    normalized = _normalize_text(text)
+def _looks_like_product_prompt(normalized: str) -> bool:
     if not normalized:
         return False
     return any(keyword in normalized for keyword in PRODUCT_PROMPT_KEYWORDS)
@@ -941,8 +957,7 @@ def _extract_budget_phrase(text: str) -> str | None:
     return match.group(0).strip()
 
 
-def _contains_price(text: str) -> bool:
-    normalized = _normalize_text(text)
+def _contains_price(normalized: str) -> bool:
     if not normalized:
         return False
     if any(word in normalized for word in PRICE_WORDS):
@@ -961,6 +976,7 @@ def validate_reply_or_rewrite(
     reasons: list[str] = []
     original_plan = plan
     text = plan.text or _plan_to_text(plan)
+    normalized_text = _normalize_text(text)
     normalized_user = _normalize_text(user_message)
     selected_product = None
     if isinstance(state, dict):
@@ -976,7 +992,8 @@ def validate_reply_or_rewrite(
         reply = "برای ارسال لینک، لطفاً اسم دقیق مدل یا یک عکس/لینک از محصول بفرستید."
         return OutboundPlan(type="text", text=reply), ["link_request_missing"]
 
-    if selected_product and _looks_like_generic_slot_prompt(text):
+    generic_slot_prompt = _looks_like_generic_slot_prompt(normalized_text)
+    if selected_product and generic_slot_prompt:
         reply = "برای ثبت سفارش، لطفاً سایز/رنگ و تعداد مدنظرتون رو بگید."
         return OutboundPlan(type="text", text=reply), ["template_blocked:selected_product"]
 
@@ -986,7 +1003,7 @@ def validate_reply_or_rewrite(
         intent = state.get("intent")
         category = state.get("category")
 
-    if intent == "store_info" and _looks_like_product_prompt(text):
+    if intent == "store_info" and _looks_like_product_prompt(normalized_text):
         reply = "بفرمایید دقیقاً کدوم اطلاعات فروشگاه مدنظرتونه؟"
         return OutboundPlan(type="text", text=reply), ["template_blocked:store_info"]
 
@@ -1001,12 +1018,12 @@ def validate_reply_or_rewrite(
         reply = fallback_llm_text()
         return OutboundPlan(type="text", text=reply), ["language_forced_fa"]
 
-    if not allow_generic_slots and _looks_like_generic_slot_prompt(text):
+    if not allow_generic_slots and generic_slot_prompt:
         reply = "برای معرفی دقیق‌تر، لطفاً نوع/رنگ یا مدل دقیق رو بفرستید."
         return OutboundPlan(type="text", text=reply), ["template_blocked:category_slots"]
 
     if text and not has_products_context and not selected_product:
-        if _contains_price(text):
+        if _contains_price(normalized_text):
             reply = "برای اعلام قیمت دقیق، لطفاً اسم/مدل محصول یا یک عکس بفرستید."
             return OutboundPlan(type="text", text=reply), ["hallucination_prevented:price"]
         if OPTION_PATTERN.search(text):
@@ -1014,7 +1031,7 @@ def validate_reply_or_rewrite(
             return OutboundPlan(type="text", text=reply), ["hallucination_prevented:options"]
 
     budget_phrase = _extract_budget_phrase(user_message or "")
-    if budget_phrase and _contains_price(text) and budget_phrase not in text:
+    if budget_phrase and _contains_price(normalized_text) and budget_phrase not in text:
         reply = f"اوکی، بازه قیمت مدنظرتون {budget_phrase} هست. مدل دقیق یا عکسش رو بفرستید."
         return OutboundPlan(type="text", text=reply), ["budget_reflected"]
 
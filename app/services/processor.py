@@ -1,15 +1,22 @@
 from __future__ import annotations
 
 import asyncio
+import heapq
 import re
 import time
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Any
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Awaitable, Callable, Iterator
 from urllib.parse import urlparse
 
 import structlog
-from sqlalchemy import Integer, cast, select
+from structlog.contextvars import bound_contextvars
+from sqlalchemy import exists, func, or_, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import defer
 
 from app.core.config import settings
 from app.core.database import AsyncSessionLocal
@@ -17,6 +24,7 @@ from app.models import (
     BotSettings,
     Campaign,
     Conversation,
+    ConversationState,
     Faq,
     Message,
     AppLog,
@@ -27,7 +35,7 @@ from app.models import (
 from app.schemas.send import OutboundPlan, QuickReplyOption
 from app.schemas.webhook import NormalizedMessage
 from app.knowledge.store import get_store_knowledge_text
-from app.services.app_log_store import log_event
+from app.services.app_log_store import emit_event, log_event
 from app.services.guardrails import (
     build_branches_plan,
     build_contact_plan,
@@ -42,12 +50,8 @@ from app.services.guardrails import (
     build_website_plan,
     format_outbound_text,
     fallback_for_message_type,
-    is_decline,
-    is_goodbye,
-    is_greeting,
-    is_negative_feedback,
     is_purchase_confirmation,
-    is_thanks,
+    keyword_hits,
     needs_product_details,
     plan_outbound,
     post_process,
@@ -55,14 +59,8 @@ from app.services.guardrails import (
     wants_product_intent,
     wants_product_address,
     wants_product_link,
-    wants_address,
-    wants_hours,
     wants_more_products,
-    wants_phone,
     wants_repeat,
-    wants_trust,
-    wants_website,
-    wants_contact,
 )
 from app.services.instagram_user_client import (
     InstagramUserClient,
@@ -72,7 +70,9 @@ from app.services.llm_clients import LLMError, generate_reply
 from app.services.llm_router import choose_provider
 from app.services.order_flow import handle_order_flow
 from app.services.product_matcher import (
+    ProductMatch,
     match_products_with_scores,
+    product_tag_info,
     tokenize_query,
 )
 from app.services.admin_media_notes import (
@@ -105,13 +105,14 @@ from app.services.product_presenter import (
     build_product_plan,
     build_product_url,
     build_selected_product_payload,
+    leading_image_urls,
     wants_product_list,
 )
 from app.services.intent_router import route_intent
 from app.services.product_taxonomy import infer_tags
 from app.services.prompts import load_prompt
 from app.services.media_analyzer import analyze_image_url, is_likely_image_url
-from app.services.sender import Sender, SenderError
+from app.services.sender import Sender, SenderError, get_sender
 from app.services.support_tickets import (
     auto_escalate_loop_to_operator,
     get_or_create_ticket,
@@ -122,6 +123,8 @@ from app.services.user_behavior_store import (
     upsert_behavior_profile,
 )
 from app.services.user_profile import extract_preferences
+from app.utils.cache import bounded_put, row_version_key
+from app.utils.keywords import KeywordClassifier
 from app.utils.time import parse_timestamp, utc_now
 
 logger = structlog.get_logger(__name__)
@@ -136,31 +139,98 @@ REQUIRED_FIELD_LABELS = {
     "category": "دسته‌بندی محصول",
 }
 DEFAULT_REQUIRED_FIELDS = ["gender", "size", "style", "budget"]
+_KNOWN_FIELD_ORDER = (
+    ("gender", "جنسیت"),
+    ("size", "سایز"),
+    ("style", "سبک"),
+    ("budget", "بازه قیمت"),
+)
+_GENERIC_SLOT_FIELDS = frozenset(DEFAULT_REQUIRED_FIELDS)
+_GENERIC_SLOT_CATEGORIES = frozenset({"shoes", "apparel"})
+_REQUIRED_MEDIA_KEYWORDS = frozenset({"مدل", "عکس", "تصویر"})
+_REQUIRED_FIELD_KEYWORDS = {
+    "gender": frozenset({"جنسیت", "آقا", "خانم", "مردانه", "زنانه", "بچگانه"}),
+    "size": frozenset({"سایز", "اندازه"}),
+    "style": frozenset({"رسمی", "اسپرت", "روزمره", "کلاسیک"}),
+    "budget": frozenset({"قیمت", "تومان", "بازه", "بودجه"}),
+    "color": frozenset({"رنگ", "رنگی", "مشکی", "سفید"}),
+    "category": frozenset({"دسته", "مدل", "نوع", "کفش", "لباس", "عطر", "آرایشی"}),
+}
+_SMALLTALK_INTENTS = frozenset({"smalltalk", "unknown"})
+_PRODUCT_LOCK_INTENTS = frozenset({"product_specific", "price_availability"})
+_SUPPORT_BEHAVIOR_PATTERNS = frozenset({"angry_customer", "checkout_help"})
+_CHAT_ROLES = frozenset({"user", "assistant"})
+# Priority order when a message mentions several store topics.
+_STORE_TOPICS = ("contact", "hours", "address", "phone", "website", "trust")
+_GUARDRAIL_STORE_TOPICS = _STORE_TOPICS[1:]
+_TEXT_PLAN_TYPES = frozenset({"text", "button", "quick_reply"})
+# Guardrail reason prefix -> the diagnostic event it is reported as.
+_GUARDRAIL_REASON_EVENTS = (
+    ("template_blocked", "template_blocked"),
+    ("hallucination_prevented", "hallucination_prevented"),
+    ("link_request", "link_request_handled"),
+)
+_ROUTER_STATE_INTENTS = {
+    "store_info": "store_info",
+    "complaint_support": "support",
+    "order_intent": "order_flow",
+}
+# Keyword hits that make a one-word message worth answering normally.
+_LOW_SIGNAL_EXEMPT_TAGS = frozenset({"greeting", "website", "address", "hours", "phone", "trust"})
+# (slot name, TagInfo field, prefs key); the query's own tags win over stored prefs.
+_FILLED_SLOT_SOURCES = (
+    ("category", "categories", "categories"),
+    ("gender", "genders", "gender"),
+    ("size", "sizes", "sizes"),
+    ("style", "styles", "styles"),
+    ("color", "colors", "colors"),
+)
+_TAG_FIELDS = ("categories", "genders", "styles", "materials", "colors", "sizes")
 SHOE_CATEGORIES = {"کفش", "صندل و دمپایی", "مجلسی و طبی"}
 APPAREL_CATEGORIES = {"پوشاک", "لباس زیر", "شال و روسری", "کلاه و شال گردن"}
 COSMETIC_CATEGORIES = {"آرایشی و بهداشتی", "آرایشی", "بهداشتی"}
 PERFUME_CATEGORIES = {"عطر و ادکلن", "ادکلن", "بادی اسپلش", "اسپری"}
 ACCESSORY_CATEGORIES = {"اکسسوری", "کیف", "جوراب", "لوازم جانبی"}
+# First matching category group decides which fields a product request needs.
+_REQUIRED_FIELDS_BY_CATEGORY: tuple[tuple[set[str], list[str]], ...] = (
+    (SHOE_CATEGORIES, DEFAULT_REQUIRED_FIELDS),
+    (APPAREL_CATEGORIES, ["gender", "size", "budget"]),
+    (COSMETIC_CATEGORIES, ["color", "budget"]),
+    (PERFUME_CATEGORIES, ["gender", "budget"]),
+    (ACCESSORY_CATEGORIES, ["gender", "budget"]),
+)
+_BUDGET_ONLY_FIELDS = ["budget"]
 PRODUCT_URL_HOSTS = {"ghlbedovom.com"}
 PRODUCT_URL_PREFIX = "/product/"
 PRODUCT_URL_RE = re.compile(r"https?://[^\s)]+")
 QUESTION_MARK_RE = re.compile(r"[؟?]")
+QUESTION_SPLIT_RE = re.compile(r"([؟?])")
 REPEAT_CLEAN_RE = re.compile(r"[^\w\u0600-\u06FF ]+")
 QUESTION_SENTENCE_RE = re.compile(r"[^؟?]*[؟?]")
 SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!؟?])\\s+")
 EMOJI_RE = re.compile(r"[\U0001F300-\U0001FAFF]")
+REPLY_LIMIT_RE = re.compile(r"[؟?\U0001F300-\U0001FAFF]")
+# Preference score dominates; microsecond recency breaks ties in one int key.
+_RANK_SCORE_WEIGHT = 1 << 53
 FOLLOWUP_PATTERNS = {
     "ready_to_buy",
     "price_inquiry",
     "availability_check",
     "comparison_request",
 }
+_USER_ENRICH_FIELDS = ("username", "follow_status", "follower_count")
+# sender_id -> (monotonic timestamp, enriched profile fields).
+_USER_ENRICH_CACHE: dict[str, tuple[float, dict[str, Any]]] = {}
+# Admin-edited prompt context (bot settings, faqs, campaigns, policy memory)
+# -> (monotonic timestamp, rows).
+_PROMPT_CONTEXT_CACHE: dict[str, tuple[float, Any]] = {}
+_PRODUCT_LINE_CACHE_MAX = 2048
+# (product id, updated_at) -> the product's line in the [PRODUCTS] prompt section.
+_PRODUCT_LINE_CACHE: dict[tuple[int, datetime | None], str] = {}
 BOOT_KEYWORDS = {
     "بوت",
     "چکمه",
     "نیم بوت",
-    "نیم‌بوت",
-    "نیم‌ بوت",
     "boot",
     "boots",
 }
@@ -186,7 +256,21 @@ _DIGIT_TRANSLATE = str.maketrans({
     "٨": "8",
     "٩": "9",
 })
+_PERSIAN_FIX = {
+    **_DIGIT_TRANSLATE,
+    **str.maketrans({
+        "ي": "ی",
+        "ى": "ی",
+        "ك": "ک",
+        "ۀ": "ه",
+        "\u200c": " ",
+    }),
+    # Arabic diacritics (tanwin, harakat, shadda, sukun, ...).
+    **{code: None for code in range(0x064B, 0x0660)},
+    0x0670: None,
+}
 PRICE_VALUE_RE = re.compile(r"(?<!\d)\d{3,}(?:[,\u066C]\d{3})*(?!\d)")
+_PRICE_SEPARATOR_STRIP = str.maketrans("", "", ",\u066C")
 PRICE_HINT_RE = re.compile(r"(قیمت|تومان|تومن|ریال|price)", re.IGNORECASE)
 IMAGE_BLIND_REPLY_RE = re.compile(
     r"(نمی.?توانم|نمی.?تونم|متوجه نمی.?شم|can't|cannot).{0,24}(تصویر|عکس|image|photo)",
@@ -198,8 +282,55 @@ GENERIC_ASSISTANT_REPLY_RE = re.compile(
 )
 
 
-def _extract_product_slug(text: str | None) -> str | None:
+def _normalize_persian(text: str | None) -> str:
     if not text:
+        return ""
+    return " ".join(text.translate(_PERSIAN_FIX).lower().split())
+
+
+def _normalize_keywords(keywords: set[str]) -> frozenset[str]:
+    return frozenset(
+        normalized for normalized in (_normalize_persian(item) for item in keywords) if normalized
+    )
+
+
+@dataclass(frozen=True)
+class TurnText:
+    intent: str
+    query: str
+    lowered: str
+    keywords: frozenset[str]
+    intent_tokens: int
+    lowered_tokens: int
+
+
+def _build_turn_text(
+    text: str | None,
+    analysis_text: str | None = None,
+    analysis_terms_text: str | None = None,
+) -> TurnText:
+    intent = (text or "").strip()
+    parts = [intent] if intent else []
+    if analysis_text:
+        parts.append(analysis_text)
+    if analysis_terms_text:
+        parts.append(analysis_terms_text)
+    query = " ".join(parts).strip()
+    lowered = _normalize_persian(intent)
+    return TurnText(
+        intent=intent,
+        query=query,
+        lowered=lowered,
+        keywords=keyword_hits(lowered),
+        intent_tokens=len(intent.split()),
+        # lowered is whitespace-collapsed, so counting separators is enough.
+        lowered_tokens=lowered.count(" ") + 1 if lowered else 0,
+    )
+
+
+def _extract_product_slug(text: str | None) -> str | None:
+    # Most messages carry no product link; skip the URL regex for them.
+    if not text or PRODUCT_URL_PREFIX not in text:
         return None
     for match in PRODUCT_URL_RE.findall(text):
         cleaned = match.rstrip(").,")
@@ -220,24 +351,53 @@ def _extract_product_slug(text: str | None) -> str | None:
     return None
 
 
+async def _find_product_by_slug(session: AsyncSession, slug: str) -> Product | None:
+    # Exact slug hits the slug index; the substring match on page_url
+    # (trigram-indexed) only runs for products whose slug column differs.
+    product = await session.scalar(select(Product).where(Product.slug == slug).limit(1))
+    if product is not None:
+        return product
+    return await session.scalar(
+        select(Product).where(Product.page_url.ilike(f"%/product/{slug}%")).limit(1)
+    )
+
+
 def _is_boot_request(text: str | None) -> bool:
     if not text:
         return False
-    normalized = text.replace("\u200c", " ").lower()
+    normalized = _normalize_persian(text)
     return any(keyword in normalized for keyword in BOOT_KEYWORDS)
 
 
+def _product_text(product: Product) -> str:
+    parts: list[str] = []
+    if product.slug:
+        parts.append(product.slug)
+    if product.title:
+        parts.append(product.title)
+    if product.description:
+        parts.append(product.description)
+    if product.product_id:
+        parts.append(product.product_id)
+    return " ".join(parts)
+
+
+def _product_refs(products: list[Product]) -> tuple[list[int], list[str]]:
+    ids: list[int] = []
+    slugs: list[str] = []
+    for product in products:
+        ids.append(product.id)
+        if product.slug:
+            slugs.append(product.slug)
+    return ids, slugs
+
+
+def _product_haystack(product: Product) -> str:
+    return _normalize_persian(_product_text(product))
+
+
 def _is_boot_product(product: Product) -> bool:
-    haystack = " ".join(
-        part
-        for part in [
-            product.slug,
-            product.title,
-            product.description,
-            product.product_id,
-        ]
-        if part
-    ).lower()
+    haystack = _product_haystack(product)
     return any(keyword in haystack for keyword in BOOT_KEYWORDS)
 
 
@@ -264,14 +424,20 @@ def _build_more_products_plan() -> OutboundPlan:
     )
 
 
-def _limit_questions(text: str, max_questions: int) -> str:
+def _limit_questions(
+    text: str, max_questions: int, total_questions: int | None = None
+) -> str:
     if not text:
         return text
     if max_questions < 0:
         return text
-    parts = re.split(r"([؟?])", text)
-    if len(parts) <= 1:
+    if total_questions is None:
+        total_questions = len(QUESTION_MARK_RE.findall(text))
+    if not total_questions:
         return text
+    if total_questions <= max_questions:
+        return text.strip() or text
+    parts = QUESTION_SPLIT_RE.split(text)
     result: list[str] = []
     question_count = 0
     for idx in range(0, len(parts), 2):
@@ -290,6 +456,9 @@ def _limit_questions(text: str, max_questions: int) -> str:
     return cleaned or text
 
 
+# A reply is compared against the last two assistant texts, and each of
+# those shows up again on the following turns, so normalizations repeat.
+@lru_cache(maxsize=256)
 def _normalize_repeat(text: str) -> str:
     cleaned = REPEAT_CLEAN_RE.sub(" ", text.lower())
     return " ".join(cleaned.split())
@@ -304,12 +473,12 @@ def _is_repetitive_reply(text: str, last_text: str | None) -> bool:
         return False
     if current == previous:
         return True
+    current_words = current.split()
+    previous_words = previous.split()
     if current in previous or previous in current:
-        return len(current.split()) >= 4 and len(previous.split()) >= 4
-    current_tokens = set(current.split())
-    previous_tokens = set(previous.split())
-    if not current_tokens or not previous_tokens:
-        return False
+        return len(current_words) >= 4 and len(previous_words) >= 4
+    current_tokens = set(current_words)
+    previous_tokens = set(previous_words)
     overlap = len(current_tokens & previous_tokens) / len(current_tokens | previous_tokens)
     return overlap >= 0.9 and len(current_tokens) >= 4
 
@@ -327,33 +496,43 @@ def _limit_emojis(text: str, max_emojis: int) -> str:
     if not text or max_emojis < 0:
         return text
     count = 0
-    output: list[str] = []
-    for ch in text:
-        if EMOJI_RE.match(ch):
-            count += 1
-            if count > max_emojis:
-                continue
-        output.append(ch)
-    return "".join(output)
+
+    def _keep_first(match: re.Match[str]) -> str:
+        nonlocal count
+        count += 1
+        return match.group(0) if count <= max_emojis else ""
+
+    return EMOJI_RE.sub(_keep_first, text)
+
+
+def _limit_reply(
+    text: str, max_questions: int, max_sentences: int, max_emojis: int
+) -> str:
+    # One scan counts question marks and emojis; the question and emoji passes
+    # only run when there is something to count, which most replies lack.
+    if not text:
+        return text
+    marks = REPLY_LIMIT_RE.findall(text)
+    emoji_count = sum(1 for mark in marks if mark not in "؟?")
+    text = _limit_questions(text, max_questions, len(marks) - emoji_count)
+    text = _limit_sentences(text, max_sentences)
+    if emoji_count > max_emojis >= 0:
+        text = _limit_emojis(text, max_emojis)
+    return text
 
 
 def _normalize_digits(text: str) -> str:
     return (text or "").translate(_DIGIT_TRANSLATE)
 
 
-def _extract_price_values(text: str | None) -> set[int]:
+def _iter_price_values(text: str | None) -> Iterator[int]:
     if not text:
-        return set()
+        return
     normalized = _normalize_digits(text)
     if not PRICE_HINT_RE.search(normalized):
-        return set()
-    values: set[int] = set()
-    for token in PRICE_VALUE_RE.findall(normalized):
-        try:
-            values.add(int(token.replace(",", "").replace("\u066C", "")))
-        except ValueError:
-            continue
-    return values
+        return
+    for match in PRICE_VALUE_RE.finditer(normalized):
+        yield int(match.group(0).translate(_PRICE_SEPARATOR_STRIP))
 
 
 def _allowed_price_values(
@@ -387,11 +566,10 @@ def _reply_has_ungrounded_price(
     reply_text: str | None,
     allowed_values: set[int],
 ) -> bool:
-    mentioned = _extract_price_values(reply_text)
-    if not mentioned:
-        return False
+    # Lazy scan: stop at the first price the context cannot ground.
+    mentioned = _iter_price_values(reply_text)
     if not allowed_values:
-        return True
+        return next(mentioned, None) is not None
     return any(not _price_is_grounded(value, allowed_values) for value in mentioned)
 
 
@@ -434,6 +612,41 @@ def _format_price_label(value: int | None) -> str:
     return "قیمت نامشخص"
 
 
+def _format_analysis_notes(analysis_text: str, payload: dict[str, Any] | None) -> str:
+    if not payload:
+        return "[IMAGE_ANALYSIS]\n" + analysis_text
+    detail_lines = [analysis_text]
+    attrs = payload.get("attributes")
+    if attrs and isinstance(attrs, dict):
+        attr_bits = [
+            f"{key}:{value}"
+            for key, value in attrs.items()
+            if isinstance(value, str) and value.strip()
+        ]
+        if attr_bits:
+            detail_lines.append("مشخصات: " + "، ".join(attr_bits))
+    tags = payload.get("tags")
+    if tags and isinstance(tags, dict):
+        tag_bits = []
+        for key in _TAG_FIELDS:
+            values = tags.get(key)
+            if isinstance(values, list) and values:
+                tag_bits.append(f"{key}={', '.join(str(v) for v in values)}")
+        if tag_bits:
+            detail_lines.append("برچسب‌ها: " + " | ".join(tag_bits))
+    search_terms = payload.get("search_terms")
+    if search_terms and isinstance(search_terms, list):
+        term_bits = []
+        for term in search_terms:
+            if isinstance(term, str):
+                cleaned = term.strip()
+                if cleaned:
+                    term_bits.append(cleaned)
+        if term_bits:
+            detail_lines.append("کلیدواژه‌ها: " + " | ".join(term_bits[:8]))
+    return "[IMAGE_ANALYSIS]\n" + "\n".join(detail_lines)
+
+
 def _build_contextual_reply(
     *,
     user: User | None,
@@ -493,56 +706,51 @@ def _remember_user_context(
     selected_product: dict[str, Any] | None,
 ) -> tuple[dict[str, Any] | None, bool]:
     original = profile_json if isinstance(profile_json, dict) else None
-    profile = dict(original or {})
-    memory = profile.get("memory")
+    memory = (original or {}).get("memory")
     if not isinstance(memory, dict):
         memory = {}
+    max_items = max(settings.USER_MEMORY_ITEMS, 1)
 
-    changed = False
-    recent_queries = memory.get("recent_queries")
-    if not isinstance(recent_queries, list):
-        recent_queries = []
-    normalized_query = " ".join((user_text or "").split())
-    if normalized_query:
-        normalized_query = normalized_query[:180]
-        if not recent_queries or recent_queries[-1] != normalized_query:
-            recent_queries.append(normalized_query)
-            changed = True
-        max_items = max(settings.USER_MEMORY_ITEMS, 1)
-        if len(recent_queries) > max_items:
-            recent_queries = recent_queries[-max_items:]
-            changed = True
-
-    recent_product_slugs = memory.get("recent_product_slugs")
-    if not isinstance(recent_product_slugs, list):
-        recent_product_slugs = []
-    seen = {slug for slug in recent_product_slugs if isinstance(slug, str)}
-    for product in (matched_products or [])[:3]:
-        slug = (product.slug or "").strip()
-        if slug and slug not in seen:
-            recent_product_slugs.append(slug)
-            seen.add(slug)
-            changed = True
+    # Work on the stored lists and only copy when something is added or
+    # trimmed; most turns change nothing and return the profile untouched.
+    stored_queries = memory.get("recent_queries")
+    if not isinstance(stored_queries, list):
+        stored_queries = []
+    recent_queries = stored_queries
+    normalized_query = " ".join((user_text or "").split())[:180]
+    if normalized_query and (not recent_queries or recent_queries[-1] != normalized_query):
+        recent_queries = [*recent_queries, normalized_query]
+    if len(recent_queries) > max_items:
+        recent_queries = recent_queries[-max_items:]
+
+    stored_slugs = memory.get("recent_product_slugs")
+    if not isinstance(stored_slugs, list):
+        stored_slugs = []
+    candidates = [(product.slug or "").strip() for product in (matched_products or [])[:3]]
     if isinstance(selected_product, dict):
         slug = selected_product.get("slug")
         if isinstance(slug, str):
-            slug = slug.strip()
-            if slug and slug not in seen:
-                recent_product_slugs.append(slug)
-                seen.add(slug)
-                changed = True
-    max_items = max(settings.USER_MEMORY_ITEMS, 1)
+            candidates.append(slug.strip())
+    seen = {slug for slug in stored_slugs if isinstance(slug, str)}
+    added: list[str] = []
+    for slug in candidates:
+        if slug and slug not in seen:
+            added.append(slug)
+            seen.add(slug)
+    recent_product_slugs = [*stored_slugs, *added] if added else stored_slugs
     if len(recent_product_slugs) > max_items:
         recent_product_slugs = recent_product_slugs[-max_items:]
-        changed = True
 
-    if changed:
-        memory["recent_queries"] = recent_queries
-        memory["recent_product_slugs"] = recent_product_slugs
-        memory["updated_at"] = utc_now().isoformat()
-        profile["memory"] = memory
-        return profile, True
-    return original, False
+    if recent_queries is stored_queries and recent_product_slugs is stored_slugs:
+        return original, False
+    profile = dict(original or {})
+    profile["memory"] = {
+        **memory,
+        "recent_queries": recent_queries,
+        "recent_product_slugs": recent_product_slugs,
+        "updated_at": utc_now().isoformat(),
+    }
+    return profile, True
 
 
 def _cross_sell_available(user: User) -> bool:
@@ -572,10 +780,8 @@ async def _maybe_add_cross_sell(
     if cross_sell.id in {product.id for product in matched_products}:
         return matched_products
     profile = user.profile_json if isinstance(user.profile_json, dict) else {}
-    if isinstance(profile, dict):
-        profile["cross_sell_ts"] = utc_now().isoformat()
-        user.profile_json = profile
-        await session.commit()
+    user.profile_json = {**profile, "cross_sell_ts": utc_now().isoformat()}
+    # The caller sends the product plan next; its commit writes both.
     await log_event(
         session,
         level="info",
@@ -585,10 +791,39 @@ async def _maybe_add_cross_sell(
             "product_id": cross_sell.id,
             "product_slug": cross_sell.slug,
         },
+        commit=False,
     )
     return matched_products + [cross_sell]
 
 
+def _classify_guardrail_reasons(
+    reasons: list[str],
+) -> tuple[list[str], list[tuple[str, str]]]:
+    # One pass: first-seen dedup plus the (event_type, reason) pairs to report.
+    seen: set[str] = set()
+    unique: list[str] = []
+    events: list[tuple[str, str]] = []
+    for reason in reasons:
+        if reason in seen:
+            continue
+        seen.add(reason)
+        unique.append(reason)
+        for prefix, event_type in _GUARDRAIL_REASON_EVENTS:
+            if reason.startswith(prefix):
+                events.append((event_type, reason))
+                break
+    return unique, events
+
+
+def _emit_guardrail_reason_events(
+    events: list[tuple[str, str]], data: dict[str, Any]
+) -> None:
+    # Kept as one row per reason: analytics and the AI context view count and
+    # list these by event_type. The sink batches them off the request path.
+    for event_type, reason in events:
+        emit_event(level="info", event_type=event_type, data={**data, "reason": reason})
+
+
 def _should_schedule_followup(
     behavior_match: BehaviorMatch | None,
     order_intent: bool,
@@ -604,6 +839,26 @@ def _should_schedule_followup(
     return bool(product_intent)
 
 
+def _profile_snapshot(user: User) -> tuple[dict[str, Any], dict[str, Any]]:
+    profile = dict(user.profile_json) if isinstance(user.profile_json, dict) else {}
+    prefs = profile.get("prefs")
+    return profile, dict(prefs) if isinstance(prefs, dict) else {}
+
+
+def _extend_unique(existing: list[Any], values: list[Any]) -> list[Any]:
+    known = set(existing)
+    # Repeated preferences are the common case; keep the list as-is then.
+    if len(known) == len(existing) and known.issuperset(values):
+        return existing
+    seen: set[Any] = set()
+    merged: list[Any] = []
+    for item in (*existing, *values):
+        if item not in seen:
+            seen.add(item)
+            merged.append(item)
+    return merged
+
+
 def _merge_pref_values(
     base: dict[str, Any] | None, updates: dict[str, Any] | None
 ) -> dict[str, Any]:
@@ -613,10 +868,7 @@ def _merge_pref_values(
             continue
         if isinstance(value, list):
             existing = merged.get(key)
-            if isinstance(existing, list):
-                merged[key] = list(dict.fromkeys(existing + value))
-            else:
-                merged[key] = list(dict.fromkeys(value))
+            merged[key] = _extend_unique(existing if isinstance(existing, list) else [], value)
         else:
             merged[key] = value
     return merged
@@ -646,49 +898,30 @@ def _merge_recent_user_text(
 
 
 def _required_fields_for_tags(query_tags: Any) -> list[str]:
-    categories = set(query_tags.categories)
+    return _required_fields_for_categories(tuple(query_tags.categories))
+
+
+@lru_cache(maxsize=256)
+def _required_fields_for_categories(categories: tuple[str, ...]) -> list[str]:
     if not categories:
         return DEFAULT_REQUIRED_FIELDS
-    if categories & SHOE_CATEGORIES:
-        return DEFAULT_REQUIRED_FIELDS
-    if categories & APPAREL_CATEGORIES:
-        return ["gender", "size", "budget"]
-    if categories & COSMETIC_CATEGORIES:
-        return ["color", "budget"]
-    if categories & PERFUME_CATEGORIES:
-        return ["gender", "budget"]
-    if categories & ACCESSORY_CATEGORIES:
-        return ["gender", "budget"]
-    return ["budget"]
-
-
-def _build_filled_slots(
-    query_tags: Any, prefs: dict[str, Any] | None, updates: dict[str, Any]
-) -> dict[str, Any]:
-    merged = _merge_pref_values(prefs, updates)
+    for group, fields in _REQUIRED_FIELDS_BY_CATEGORY:
+        if not group.isdisjoint(categories):
+            return fields
+    return _BUDGET_ONLY_FIELDS
+
+
+def _build_filled_slots(query_tags: Any, prefs: dict[str, Any] | None) -> dict[str, Any]:
+    prefs = prefs or {}
     slots: dict[str, Any] = {}
-    if query_tags.categories:
-        slots["category"] = list(query_tags.categories)
-    elif merged.get("categories"):
-        slots["category"] = merged.get("categories")
-    if query_tags.genders:
-        slots["gender"] = list(query_tags.genders)
-    elif merged.get("gender"):
-        slots["gender"] = merged.get("gender")
-    if query_tags.sizes:
-        slots["size"] = list(query_tags.sizes)
-    elif merged.get("sizes"):
-        slots["size"] = merged.get("sizes")
-    if query_tags.styles:
-        slots["style"] = list(query_tags.styles)
-    elif merged.get("styles"):
-        slots["style"] = merged.get("styles")
-    if query_tags.colors:
-        slots["color"] = list(query_tags.colors)
-    elif merged.get("colors"):
-        slots["color"] = merged.get("colors")
-    budget_min = merged.get("budget_min")
-    budget_max = merged.get("budget_max")
+    for slot, tag_field, pref_key in _FILLED_SLOT_SOURCES:
+        tags = getattr(query_tags, tag_field)
+        if tags:
+            slots[slot] = list(tags)
+        elif prefs.get(pref_key):
+            slots[slot] = prefs[pref_key]
+    budget_min = prefs.get("budget_min")
+    budget_max = prefs.get("budget_max")
     if isinstance(budget_min, int) or isinstance(budget_max, int):
         slots["budget"] = {"min": budget_min, "max": budget_max}
     return slots
@@ -840,8 +1073,7 @@ def _split_show_products(text: str) -> tuple[bool, str]:
         cleaned = text.replace(SHOW_PRODUCTS_TOKEN, "").replace(SHOW_PRODUCTS_TOKEN_ALT, "")
         cleaned = "\n".join(line.rstrip() for line in cleaned.splitlines()).strip()
         return True, cleaned
-    lines = [line.rstrip() for line in text.splitlines()]
-    cleaned = "\n".join(line for line in lines).strip()
+    cleaned = "\n".join([line.rstrip() for line in text.splitlines()]).strip()
     return False, cleaned
 
 
@@ -923,46 +1155,61 @@ def _missing_required_fields(
     return missing, known
 
 
+def _build_known_prefix(known: dict[str, str]) -> str:
+    known_parts = [
+        f"{label}: {known[key]}" for key, label in _KNOWN_FIELD_ORDER if key in known
+    ]
+    if not known_parts:
+        return ""
+    return f"{' | '.join(known_parts)}. "
+
+
+@lru_cache(maxsize=256)
+def _join_required_labels(missing: tuple[str, ...]) -> str:
+    labels = [REQUIRED_FIELD_LABELS[field] for field in missing]
+    if len(labels) == 1:
+        return labels[0]
+    if len(labels) == 2:
+        return " و ".join(labels)
+    return "، ".join(labels[:-1]) + " و " + labels[-1]
+
+
 def _format_required_question(missing: list[str], known: dict[str, str]) -> str:
-    known_parts = []
-    for key, label in (("gender", "جنسیت"), ("size", "سایز"), ("style", "سبک"), ("budget", "بازه قیمت")):
-        if key in known:
-            known_parts.append(f"{label}: {known[key]}")
-    prefix = ""
-    if known_parts:
-        prefix = f"{' | '.join(known_parts)}. "
+    prefix = _build_known_prefix(known)
     if not missing:
         return prefix + "برای معرفی دقیق‌تر، لطفاً اسم دقیق مدل یا عکسش رو بفرستید."
-    labels = [REQUIRED_FIELD_LABELS[field] for field in missing]
-    if len(labels) == 1:
-        ask = labels[0]
-    elif len(labels) == 2:
-        ask = " و ".join(labels)
-    else:
-        ask = "، ".join(labels[:-1]) + " و " + labels[-1]
+    ask = _join_required_labels(tuple(missing))
     return prefix + f"برای معرفی دقیق‌تر، لطفاً {ask} رو بگید."
 
 
 def _format_required_question_alt(missing: list[str], known: dict[str, str]) -> str:
-    known_parts = []
-    for key, label in (("gender", "جنسیت"), ("size", "سایز"), ("style", "سبک"), ("budget", "بازه قیمت")):
-        if key in known:
-            known_parts.append(f"{label}: {known[key]}")
-    prefix = ""
-    if known_parts:
-        prefix = f"{' | '.join(known_parts)}. "
-    labels = [REQUIRED_FIELD_LABELS[field] for field in missing] if missing else []
-    if not labels:
+    prefix = _build_known_prefix(known)
+    if not missing:
         return prefix + "برای معرفی دقیق‌تر، لطفاً اسم دقیق مدل یا عکسش رو بفرستید."
-    if len(labels) == 1:
-        ask = labels[0]
-    elif len(labels) == 2:
-        ask = " و ".join(labels)
-    else:
-        ask = "، ".join(labels[:-1]) + " و " + labels[-1]
+    ask = _join_required_labels(tuple(missing))
     return prefix + f"برای اینکه دقیق پیشنهاد بدم، فقط {ask} رو بفرستید."
 
 
+def _first_store_topic(
+    hits: frozenset[str], topics: tuple[str, ...] = _STORE_TOPICS
+) -> str | None:
+    return next((topic for topic in topics if topic in hits), None)
+
+
+def _partition_history(
+    history: list[Message],
+) -> tuple[list[Message], list[Message]]:
+    user_messages: list[Message] = []
+    assistant_messages: list[Message] = []
+    for msg in history:
+        if msg.role == "user":
+            if msg.type != "read":
+                user_messages.append(msg)
+        elif msg.role == "assistant":
+            assistant_messages.append(msg)
+    return user_messages, assistant_messages
+
+
 def _last_assistant_text(history: list[Message]) -> str | None:
     recent = _recent_assistant_texts(history, limit=1)
     return recent[0] if recent else None
@@ -984,36 +1231,59 @@ def _recent_assistant_texts(history: list[Message], limit: int = 3) -> list[str]
     return texts
 
 
+_REQUIRED_FIELD_CLASSIFIER = KeywordClassifier(
+    {**_REQUIRED_FIELD_KEYWORDS, "media": _REQUIRED_MEDIA_KEYWORDS},
+    normalize=_normalize_persian,
+)
+
+
 def _contains_required_fields(text: str, missing: list[str]) -> bool:
     if not text:
         return False
+    hits = _REQUIRED_FIELD_CLASSIFIER.classify(text)
     if not missing:
-        lowered = text.lower()
-        return any(keyword in lowered for keyword in ["مدل", "عکس", "تصویر"])
-    lowered = text.lower()
-    checks = {
-        "gender": ["جنسیت", "آقا", "خانم", "مردانه", "زنانه", "بچگانه"],
-        "size": ["سایز", "اندازه"],
-        "style": ["رسمی", "اسپرت", "روزمره", "کلاسیک"],
-        "budget": ["قیمت", "تومان", "بازه", "بودجه"],
-        "color": ["رنگ", "رنگی", "مشکی", "سفید"],
-        "category": ["دسته", "مدل", "نوع", "کفش", "لباس", "عطر", "آرایشی"],
-    }
-    return all(any(keyword in lowered for keyword in checks[field]) for field in missing)
+        return "media" in hits
+    return all(field in hits for field in missing)
 
 
 def _is_low_signal(text: str | None) -> bool:
     if not text:
         return False
-    tokens = [token for token in text.strip().split() if token]
-    return len(tokens) <= 1
+    return len(text.split(maxsplit=1)) <= 1
+
+
+def _match_confidence(top_score: int | None, token_count: int, has_tags: bool) -> bool:
+    if top_score is None:
+        return False
+    if not token_count and has_tags:
+        return True
+    return top_score >= max(2, token_count)
+
+
+def _recency_key(product: Product) -> int:
+    updated_at = product.updated_at
+    if not isinstance(updated_at, datetime):
+        return 0
+    return max(int(updated_at.timestamp() * 1_000_000), 0)
+
+
+def _price_in_budget(
+    price: int | None, budget_min: int | None, budget_max: int | None
+) -> bool:
+    if price is None:
+        return False
+    return (budget_min is None or price >= budget_min) and (
+        budget_max is None or price <= budget_max
+    )
 
 
 def _rank_products_by_prefs(
     products: list[Product],
     prefs: dict[str, Any] | None,
+    top_k: int | None = None,
+    score_cache: dict[int, int] | None = None,
 ) -> list[Product]:
-    if not products or not prefs:
+    if len(products) <= 1 or not prefs:
         return products
     tokens: list[str] = []
     for key in ("categories", "gender", "colors"):
@@ -1022,48 +1292,49 @@ def _rank_products_by_prefs(
             tokens.extend([item for item in value if isinstance(item, str)])
         elif isinstance(value, str):
             tokens.append(value)
-    tokens = [token.strip().lower() for token in tokens if token and token.strip()]
+    tokens = [_normalize_persian(token) for token in tokens if token and token.strip()]
     budget_min = prefs.get("budget_min") if isinstance(prefs.get("budget_min"), int) else None
     budget_max = prefs.get("budget_max") if isinstance(prefs.get("budget_max"), int) else None
-    if not tokens and budget_min is None and budget_max is None:
+    has_budget = budget_min is not None or budget_max is not None
+    if not tokens and not has_budget:
         return products
-    if budget_min is not None or budget_max is not None:
-        in_budget = []
-        for product in products:
-            if product.price is None:
-                continue
-            if (budget_min is None or product.price >= budget_min) and (
-                budget_max is None or product.price <= budget_max
-            ):
-                in_budget.append(product)
+    if has_budget:
+        in_budget = [
+            product
+            for product in products
+            if _price_in_budget(product.price, budget_min, budget_max)
+        ]
         if in_budget:
             products = in_budget
-    scored: list[tuple[int, datetime, Product]] = []
+    # score_cache maps product id -> score for one prefs dict, so callers
+    # ranking overlapping lists in the same turn score each product once.
+    scores: list[int] = []
     for product in products:
-        haystack = " ".join(
-            part
-            for part in [
-                product.slug,
-                product.title,
-                product.description,
-                product.product_id,
-            ]
-            if part
-        ).lower()
-        score = sum(1 for token in tokens if token in haystack)
-        if product.price is not None and (budget_min is not None or budget_max is not None):
-            if (budget_min is None or product.price >= budget_min) and (
-                budget_max is None or product.price <= budget_max
-            ):
+        score = score_cache.get(product.id) if score_cache is not None else None
+        if score is None:
+            haystack = _product_haystack(product)
+            score = sum(1 for token in tokens if token in haystack)
+            if has_budget and _price_in_budget(product.price, budget_min, budget_max):
                 score += 1
-        scored.append((score, product.updated_at or datetime.min, product))
-    max_score = max(item[0] for item in scored) if scored else 0
+            if score_cache is not None:
+                score_cache[product.id] = score
+        scores.append(score)
+    max_score = max(scores) if scores else 0
     if max_score <= 0:
+        return products if top_k is None else products[:top_k]
+    if len(products) == 1:
         return products
-    scored.sort(key=lambda item: (item[0], item[1]), reverse=True)
-    return [item[2] for item in scored]
+    scored: list[tuple[int, Product]] = [
+        (score * _RANK_SCORE_WEIGHT + _recency_key(product), product)
+        for score, product in zip(scores, products)
+    ]
+    if top_k is not None and top_k < len(scored):
+        scored = heapq.nlargest(top_k, scored, key=itemgetter(0))
+    else:
+        scored.sort(key=itemgetter(0), reverse=True)
+    return [item[1] for item in scored]
 
-SALES_KEYWORDS = {
+SALES_KEYWORDS = _normalize_keywords({
     "price",
     "pricing",
     "buy",
@@ -1073,8 +1344,8 @@ SALES_KEYWORDS = {
     "خرید",
     "سفارش",
     "پرداخت",
-}
-SUPPORT_KEYWORDS = {
+})
+SUPPORT_KEYWORDS = _normalize_keywords({
     "problem",
     "issue",
     "error",
@@ -1087,40 +1358,59 @@ SUPPORT_KEYWORDS = {
     "شکایت",
     "مرجوع",
     "پشتیبانی",
-}
+})
+# One scan tags a message as sales and/or support for prompt selection.
+_PROMPT_TOPIC_CLASSIFIER = KeywordClassifier(
+    {"sales": SALES_KEYWORDS, "support": SUPPORT_KEYWORDS},
+    normalize=_normalize_persian,
+)
 FAQ_MATCH_MIN_LEN = 4
+_FAQ_MATCHER_FAQS: list[Faq] | None = None
+_FAQ_MATCHER: KeywordClassifier[int] | None = None
+
+
+_MESSAGE_TYPE_MAP = {
+    "image": "media",
+    "photo": "media",
+    "picture": "media",
+    "video": "media",
+    "media": "media",
+    "audio": "audio",
+    "voice": "audio",
+    "text": "text",
+    "quick_reply": "text",
+    "postback": "text",
+    "button": "text",
+    "interactive": "text",
+    "read": "read",
+}
+_TRUE_STRINGS = frozenset({"true", "1", "yes"})
+_FALSE_STRINGS = frozenset({"false", "0", "no"})
 
 
-def normalize_webhook(payload: dict[str, Any]) -> NormalizedMessage:
-    def _coerce_bool(value: Any) -> bool:
-        if isinstance(value, bool):
-            return value
-        if isinstance(value, (int, float)):
-            return value != 0
-        if isinstance(value, str):
-            lowered = value.strip().lower()
-            if lowered in {"true", "1", "yes"}:
-                return True
-            if lowered in {"false", "0", "no"}:
-                return False
-        return bool(value)
+def _coerce_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in _TRUE_STRINGS:
+            return True
+        if lowered in _FALSE_STRINGS:
+            return False
+    return bool(value)
+
 
+def normalize_webhook(payload: dict[str, Any]) -> NormalizedMessage:
     sender_id = payload.get("sender")
     receiver_id = payload.get("receiver")
     message_type = payload.get("message_type")
     if not sender_id or not receiver_id or not message_type:
         raise ValueError("Missing sender, receiver, or message_type")
 
-    raw_type = str(message_type).lower().strip()
-    if raw_type in {"image", "photo", "picture", "video", "media"}:
-        message_type = "media"
-    elif raw_type in {"audio", "voice"}:
-        message_type = "audio"
-    elif raw_type in {"text", "quick_reply", "postback", "button", "interactive"}:
-        message_type = "text"
-    elif raw_type == "read":
-        message_type = "read"
-    else:
+    message_type = _MESSAGE_TYPE_MAP.get(str(message_type).lower().strip())
+    if message_type is None:
         raise ValueError("Unsupported message_type")
 
     text = payload.get("text")
@@ -1185,6 +1475,29 @@ def normalize_payload(payload: dict[str, Any]) -> NormalizedMessage:
     return normalize_webhook(payload)
 
 
+def _cached_user_profile(sender_id: str) -> dict[str, Any] | None:
+    entry = _USER_ENRICH_CACHE.get(sender_id)
+    if not entry:
+        return None
+    stored_at, fields = entry
+    if time.monotonic() - stored_at >= settings.USER_ENRICH_TTL_SEC:
+        _USER_ENRICH_CACHE.pop(sender_id, None)
+        return None
+    return fields
+
+
+def _store_user_profile(message: NormalizedMessage) -> None:
+    limit = settings.USER_ENRICH_CACHE_MAX
+    if settings.USER_ENRICH_TTL_SEC <= 0 or limit <= 0:
+        return
+    bounded_put(
+        _USER_ENRICH_CACHE,
+        message.sender_id,
+        (time.monotonic(), {field: getattr(message, field) for field in _USER_ENRICH_FIELDS}),
+        limit,
+    )
+
+
 async def enrich_user_profile(message: NormalizedMessage) -> None:
     if (
         message.username
@@ -1195,16 +1508,36 @@ async def enrich_user_profile(message: NormalizedMessage) -> None:
     if not settings.DIRECTAM_BASE_URL or not settings.SERVICE_API_KEY:
         return
 
+    cached = _cached_user_profile(message.sender_id)
+    if cached:
+        for field, value in cached.items():
+            if getattr(message, field) is None:
+                setattr(message, field, value)
+        return
+
     client = InstagramUserClient()
-    try:
-        if not message.username:
-            message.username = await client.get_username(message.sender_id)
-        if not message.follow_status:
-            message.follow_status = await client.get_follow_status(message.sender_id)
-        if message.follower_count is None:
-            message.follower_count = await client.get_follow_count(message.sender_id)
-    except InstagramUserClientError as exc:
-        logger.warning("user_enrich_failed", error=str(exc))
+    lookups: dict[str, Any] = {}
+    if not message.username:
+        lookups["username"] = client.get_username(message.sender_id)
+    if not message.follow_status:
+        lookups["follow_status"] = client.get_follow_status(message.sender_id)
+    if message.follower_count is None:
+        lookups["follower_count"] = client.get_follow_count(message.sender_id)
+    # The lookups are independent, so their round-trips overlap.
+    results = await asyncio.gather(*lookups.values(), return_exceptions=True)
+    failed = False
+    for field, result in zip(lookups, results):
+        if isinstance(result, InstagramUserClientError):
+            logger.warning("user_enrich_failed", field=field, error=str(result))
+            failed = True
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        setattr(message, field, result)
+    if failed:
+        _USER_ENRICH_CACHE.pop(message.sender_id, None)
+    else:
+        _store_user_profile(message)
 
 
 async def handle_webhook(payload: dict[str, Any]) -> None:
@@ -1234,7 +1567,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
             record = await save_message(session, conversation.id, normalized, role)
             if role == "user" and normalized.message_type != "read":
                 conversation.last_user_message_at = normalized.timestamp or utc_now()
-            last_user_message_id = record.id if role == "user" else None
             await log_event(
                 session,
                 level="info",
@@ -1247,6 +1579,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 commit=False,
             )
             await session.commit()
+            last_user_message_id = record.id if role == "user" else None
 
             if normalized.is_admin:
                 note_url = normalized.media_url or normalized.audio_url
@@ -1260,6 +1593,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         message_id=record.id,
                         media_url=note_url,
                         tag=tag,
+                        commit=False,
                     )
                     await log_event(
                         session,
@@ -1270,8 +1604,9 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "message_id": record.id,
                             "media_url": note_url,
                         },
+                        commit=False,
                     )
-                    await session.commit()
+                stored_policy = False
                 if normalized.text and normalized.text.strip():
                     stored_policy = await store_admin_policy_memory(
                         session,
@@ -1280,8 +1615,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         conversation_id=conversation.id,
                         message_id=record.id,
                     )
-                    if stored_policy:
-                        await session.commit()
+                if note_url or stored_policy:
+                    await session.commit()
+                if stored_policy:
+                    _PROMPT_CONTEXT_CACHE.pop("policy_memory", None)
 
             if role == "user" and normalized.message_type != "read":
                 await cancel_followups_for_conversation(
@@ -1294,15 +1631,16 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 and settings.MESSAGE_DEBOUNCE_SEC > 0
             ):
                 await asyncio.sleep(settings.MESSAGE_DEBOUNCE_SEC)
-                newer = await session.execute(
-                    select(Message.id)
-                    .where(Message.conversation_id == conversation.id)
-                    .where(Message.role == "user")
-                    .where(Message.type != "read")
-                    .where(Message.id > record.id)
-                    .limit(1)
+                has_newer = await session.scalar(
+                    select(
+                        exists()
+                        .where(Message.conversation_id == conversation.id)
+                        .where(Message.role == "user")
+                        .where(Message.type != "read")
+                        .where(Message.id > record.id)
+                    )
                 )
-                if newer.scalar_one_or_none():
+                if has_newer:
                     await log_event(
                         session,
                         level="info",
@@ -1355,12 +1693,20 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 logger.info("read_ignored", sender_id=normalized.sender_id)
                 return
 
-            bot_settings = await get_active_bot_settings(session)
-            max_history = (
-                bot_settings.max_history_messages
-                if bot_settings and bot_settings.max_history_messages
-                else settings.MAX_HISTORY_MESSAGES
+            bot_settings = await _cached_prompt_context(
+                "bot_settings", lambda: _read_in_own_session(get_active_bot_settings)
             )
+            # Resolve the settings-row overrides once for the whole turn.
+            if bot_settings:
+                max_history = bot_settings.max_history_messages or settings.MAX_HISTORY_MESSAGES
+                max_chars = bot_settings.max_output_chars or settings.MAX_RESPONSE_CHARS
+                fallback_override = bot_settings.fallback_text
+                admin_notes = bot_settings.admin_notes
+                ai_mode = bot_settings.ai_mode
+            else:
+                max_history = settings.MAX_HISTORY_MESSAGES
+                max_chars = settings.MAX_RESPONSE_CHARS
+                fallback_override = admin_notes = ai_mode = None
             history_limit = max_history
             if settings.LLM_MAX_USER_TURNS > 0:
                 history_limit = min(
@@ -1386,13 +1732,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     },
                     commit=False,
                 )
-                await session.commit()
-            recent_assistant_texts = _recent_assistant_texts(history, limit=3)
+            user_messages, assistant_messages = _partition_history(history)
+            recent_assistant_texts = _recent_assistant_texts(assistant_messages, limit=3)
             last_assistant_text = recent_assistant_texts[0] if recent_assistant_texts else None
-            is_first_message = (
-                sum(1 for msg in history if msg.role == "user" and msg.type != "read")
-                <= 1
-            )
+            is_first_message = len(user_messages) <= 1
             catalog_snapshot = await get_catalog_snapshot(session)
             catalog_summary = catalog_snapshot.summary if catalog_snapshot else None
             behavior_match: BehaviorMatch | None = None
@@ -1401,21 +1744,24 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
             behavior_meta: dict[str, Any] | None = None
             behavior_snapshot: dict[str, Any] | None = None
             def _merge_meta(extra: dict[str, Any] | None) -> dict[str, Any] | None:
-                if behavior_meta is None and not extra:
-                    return None
-                merged: dict[str, Any] = {}
-                if behavior_meta:
-                    merged.update(behavior_meta)
-                if extra:
-                    merged.update(extra)
-                return merged
+                # Branch metas are fresh literals, so they can be passed through
+                # untouched unless behavior tags have to be layered underneath.
+                if not behavior_meta:
+                    return extra or None
+                return {**behavior_meta, **extra} if extra else dict(behavior_meta)
 
             llm_first_all = settings.LLM_FIRST_ALL
-            intent_text = (merged_text or normalized.text or "").strip()
-            query_text = " ".join(
-                part for part in [intent_text, analysis_text, analysis_terms_text] if part
-            ).strip()
-            lowered = intent_text.lower()
+            turn_text = _build_turn_text(
+                merged_text or normalized.text,
+                analysis_text,
+                analysis_terms_text,
+            )
+            intent_text = turn_text.intent
+            query_text = turn_text.query
+            query_category = infer_state_category(query_text)
+            lowered = turn_text.lowered
+            lowered_hits = turn_text.keywords
+            store_topic_hit = _first_store_topic(lowered_hits)
             behavior_input = intent_text or analysis_text
             conversation_state_payload: dict[str, Any] | None = None
             router_decision = route_intent(query_text or intent_text)
@@ -1435,6 +1781,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 last_handler_used: str | None = None,
                 increment_loop: bool = False,
                 reset_loop: bool = False,
+                commit: bool = True,
             ) -> dict[str, Any] | None:
                 state = await get_or_create_state(session, conversation.id)
                 prior_payload = build_state_payload(state)
@@ -1442,7 +1789,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     session,
                     conversation.id,
                     intent,
-                    category or infer_state_category(query_text),
+                    category or query_category,
                     required_slots,
                     filled_slots,
                     intent_text,
@@ -1453,22 +1800,35 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     last_handler_used=last_handler_used,
                     increment_loop=increment_loop,
                     reset_loop=reset_loop,
-                )
-                next_payload = build_state_payload(state)
-                await log_event(
-                    session,
-                    level="info",
-                    event_type="state_updated",
-                    data={
-                        "conversation_id": conversation.id,
-                        "user_id": user.id,
-                        "prior_state": prior_payload,
-                        "next_state": next_payload,
-                    },
                     commit=False,
                 )
-                await session.commit()
+                next_payload = build_state_payload(state)
+                if next_payload != prior_payload:
+                    await log_event(
+                        session,
+                        level="info",
+                        event_type="state_updated",
+                        data={
+                            "conversation_id": conversation.id,
+                            "user_id": user.id,
+                            "prior_state": prior_payload,
+                            "next_state": next_payload,
+                        },
+                        commit=False,
+                    )
+                if commit:
+                    await session.commit()
                 return next_payload
+
+            match_cache: dict[tuple[str, int], list[ProductMatch]] = {}
+
+            async def _match_products(text: str, limit: int) -> list[ProductMatch]:
+                key = (" ".join(text.split()), limit)
+                if key not in match_cache:
+                    match_cache[key] = await match_products_with_scores(
+                        session, text, limit=limit
+                    )
+                return match_cache[key]
             if behavior_input:
                 behavior_match, behavior_summary, behavior_recent = await analyze_user_behavior(
                     session,
@@ -1484,6 +1844,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     last_message=behavior_input,
                     summary_counts=behavior_summary,
                     recent_payload=behavior_recent,
+                    commit=False,
                 )
                 behavior_snapshot = build_behavior_snapshot(
                     behavior_profile,
@@ -1511,14 +1872,15 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         },
                         commit=False,
                     )
-                    await session.commit()
+                await session.commit()
 
                 store_intent = router_intent == "store_info"
                 if not llm_first_all:
-                    if is_thanks(lowered):
+                    if "thanks" in lowered_hits:
                         conversation_state_payload = await _touch_state(
                             "unknown",
-                            category=infer_state_category(query_text),
+                            category=query_category,
+                            commit=False,
                         )
                         await send_and_store(
                             session,
@@ -1528,10 +1890,11 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             meta=_merge_meta({"source": "guardrails", "intent": "thanks"}),
                         )
                         return
-                    if is_decline(lowered):
+                    if "decline" in lowered_hits:
                         conversation_state_payload = await _touch_state(
                             "unknown",
-                            category=infer_state_category(query_text),
+                            category=query_category,
+                            commit=False,
                         )
                         await send_and_store(
                             session,
@@ -1541,10 +1904,11 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             meta=_merge_meta({"source": "guardrails", "intent": "decline"}),
                         )
                         return
-                    if is_goodbye(lowered):
+                    if "goodbye" in lowered_hits:
                         conversation_state_payload = await _touch_state(
                             "unknown",
-                            category=infer_state_category(query_text),
+                            category=query_category,
+                            commit=False,
                         )
                         await send_and_store(
                             session,
@@ -1555,17 +1919,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         )
                         return
                     if store_intent:
-                        store_topic = None
-                        if wants_hours(lowered):
-                            store_topic = "hours"
-                        elif wants_address(lowered):
-                            store_topic = "address"
-                        elif wants_phone(lowered):
-                            store_topic = "phone"
-                        elif wants_website(lowered):
-                            store_topic = "website"
-                        elif wants_trust(lowered):
-                            store_topic = "trust"
+                        store_topic = _first_store_topic(lowered_hits, _GUARDRAIL_STORE_TOPICS)
                         rule_plan = build_rule_based_plan(
                             normalized.message_type,
                             normalized.text,
@@ -1574,9 +1928,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         if rule_plan:
                             conversation_state_payload = await _touch_state(
                                 "store_info",
-                                category=infer_state_category(query_text),
+                                category=query_category,
                                 last_handler_used="store_info",
                                 reset_loop=True,
+                                commit=False,
                             )
                             await send_plan_and_store(
                                 session,
@@ -1599,52 +1954,33 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 )
 
             support_intent = router_intent == "complaint_support"
-            if behavior_match and behavior_match.pattern in {"angry_customer", "checkout_help"}:
+            if behavior_match and behavior_match.pattern in _SUPPORT_BEHAVIOR_PATTERNS:
                 support_intent = True
-            if any(keyword in lowered for keyword in SUPPORT_KEYWORDS):
+            if "support" in _PROMPT_TOPIC_CLASSIFIER.classify(lowered, normalized=True):
                 support_intent = True
 
             state = await get_or_create_state(session, conversation.id)
-            selected_product_state = (
+            # Always a payload dict or None from here on, so no per-use isinstance checks.
+            selected_product_state: dict[str, Any] | None = (
                 state.selected_product if isinstance(state.selected_product, dict) else None
             )
             url_slug = _extract_product_slug(intent_text)
             product_from_url: Product | None = None
             if url_slug:
-                result = await session.execute(
-                    select(Product).where(
-                        (Product.slug == url_slug)
-                        | Product.page_url.ilike(f"%/product/{url_slug}%")
-                    )
-                )
-                product_from_url = result.scalars().first()
+                product_from_url = await _find_product_by_slug(session, url_slug)
                 if product_from_url:
                     selected_product_state = build_selected_product_payload(product_from_url)
 
             if wants_repeat(intent_text):
                 conversation_state_payload = await _touch_state(
                     state.intent or "unknown",
-                    category=state.category or infer_state_category(query_text),
+                    category=state.category or query_category,
                     required_slots=state.slots_required,
                     filled_slots=state.slots_filled,
                     last_handler_used="repeat",
                     reset_loop=True,
                 )
-                explicit_topic = None
-                if wants_contact(lowered):
-                    explicit_topic = "contact"
-                elif wants_hours(lowered):
-                    explicit_topic = "hours"
-                elif wants_address(lowered):
-                    explicit_topic = "address"
-                elif wants_phone(lowered):
-                    explicit_topic = "phone"
-                elif wants_website(lowered):
-                    explicit_topic = "website"
-                elif wants_trust(lowered):
-                    explicit_topic = "trust"
-
-                store_topic = explicit_topic
+                store_topic = store_topic_hit
                 if store_topic is None:
                     recent_logs = await get_recent_response_logs(
                         session, conversation.id, max(5, settings.RESPONSE_LOG_CONTEXT_LIMIT)
@@ -1659,6 +1995,17 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     last_assistant_text=last_assistant_text,
                 )
                 if plan:
+                    await log_event(
+                        session,
+                        level="info",
+                        event_type="repeat_handled",
+                        data={
+                            "conversation_id": conversation.id,
+                            "user_id": user.id,
+                            "store_topic": store_topic,
+                        },
+                        commit=False,
+                    )
                     await send_plan_and_store(
                         session,
                         conversation.id,
@@ -1670,29 +2017,21 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "handler": "repeat",
                             **repeat_meta,
                         }),
-                    )
-                    await log_event(
-                        session,
-                        level="info",
-                        event_type="repeat_handled",
-                        data={
-                            "conversation_id": conversation.id,
-                            "user_id": user.id,
-                            "store_topic": store_topic,
-                        },
+                        state=state,
                     )
                     return
 
-            if is_negative_feedback(lowered):
+            if "negative_feedback" in lowered_hits:
                 loop_payload = await _touch_state(
                     state.intent or "unknown",
-                    category=state.category or infer_state_category(query_text),
+                    category=state.category or query_category,
                     required_slots=state.slots_required,
                     filled_slots=state.slots_filled,
                     selected_product=selected_product_state,
                     preserve_selected_product=True,
                     last_handler_used="loop_breaker",
                     increment_loop=True,
+                    commit=False,
                 )
                 loop_count = 0
                 if isinstance(loop_payload, dict):
@@ -1709,7 +2048,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     },
                     commit=False,
                 )
-                await session.commit()
                 escalated_ticket = None
                 if settings.LOOP_AUTO_ESCALATE_ENABLED:
                     escalated_ticket = await auto_escalate_loop_to_operator(
@@ -1752,16 +2090,17 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         "ticket_id": escalated_ticket.id if escalated_ticket else None,
                         "auto_escalated": bool(escalated_ticket),
                     }),
+                    state=state,
                 )
                 return
 
-            token_count = len(lowered.split()) if lowered else 0
-            if is_greeting(lowered) and token_count <= 3 and router_intent in {"smalltalk", "unknown"}:
+            if "greeting" in lowered_hits and turn_text.lowered_tokens <= 3 and router_intent in _SMALLTALK_INTENTS:
                 conversation_state_payload = await _touch_state(
                     "unknown",
-                    category=state.category or infer_state_category(query_text),
+                    category=state.category or query_category,
                     last_handler_used="greeting",
                     reset_loop=True,
+                    commit=False,
                 )
                 await send_plan_and_store(
                     session,
@@ -1773,6 +2112,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         "intent": "greeting",
                         "handler": "greeting",
                     }),
+                    state=state,
                 )
                 return
 
@@ -1787,9 +2127,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 elif recent_count > 1:
                     conversation_state_payload = await _touch_state(
                         "product_search",
-                        category=infer_state_category(query_text),
+                        category=query_category,
                         required_slots=state.slots_required,
                         filled_slots=state.slots_filled,
+                        commit=False,
                     )
                     clarification = (
                         "کدوم مدل مدنظرتونه؟ لطفاً اسم دقیق یا لینک محصول رو بفرستید."
@@ -1803,23 +2144,36 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "source": "guardrails",
                             "intent": "product_disambiguate",
                         }),
+                        state=state,
                     )
                     return
 
             if link_request:
-                page_url = None
-                if isinstance(selected_product_state, dict):
-                    page_url = selected_product_state.get("page_url")
+                page_url = (
+                    selected_product_state.get("page_url") if selected_product_state else None
+                )
                 if page_url:
                     conversation_state_payload = await _touch_state(
                         "product_selected",
-                        category=infer_state_category(query_text),
+                        category=query_category,
                         selected_product=selected_product_state,
                         preserve_selected_product=False,
                         last_handler_used="product_link",
                         reset_loop=True,
+                        commit=False,
                     )
                     reply_text = f"حتماً 🙂 لینک مستقیم محصول: {page_url}"
+                    await log_event(
+                        session,
+                        level="info",
+                        event_type="link_request_handled",
+                        data={
+                            "conversation_id": conversation.id,
+                            "user_id": user.id,
+                            "page_url": page_url,
+                        },
+                        commit=False,
+                    )
                     await send_plan_and_store(
                         session,
                         conversation.id,
@@ -1829,27 +2183,28 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "source": "guardrails",
                             "intent": "product_link",
                             "handler": "product_link",
-                            "product_id": selected_product_state.get("product_id")
-                            if isinstance(selected_product_state, dict)
-                            else None,
+                            "product_id": selected_product_state.get("product_id"),
                         }),
-                    )
-                    await log_event(
-                        session,
-                        level="info",
-                        event_type="link_request_handled",
-                        data={
-                            "conversation_id": conversation.id,
-                            "user_id": user.id,
-                            "page_url": page_url,
-                        },
+                        state=state,
                     )
                     return
                 conversation_state_payload = await _touch_state(
                     "product_search",
-                    category=infer_state_category(query_text),
+                    category=query_category,
                     last_handler_used="product_link_missing",
                     reset_loop=True,
+                    commit=False,
+                )
+                await log_event(
+                    session,
+                    level="info",
+                    event_type="link_request_handled",
+                    data={
+                        "conversation_id": conversation.id,
+                        "user_id": user.id,
+                        "page_url": None,
+                    },
+                    commit=False,
                 )
                 await send_plan_and_store(
                     session,
@@ -1864,29 +2219,32 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         "intent": "product_link_missing",
                         "handler": "product_link_missing",
                     }),
-                )
-                await log_event(
-                    session,
-                    level="info",
-                    event_type="link_request_handled",
-                    data={
-                        "conversation_id": conversation.id,
-                        "user_id": user.id,
-                        "page_url": None,
-                    },
+                    state=state,
                 )
                 return
 
             if purchase_confirm and selected_product_state:
                 conversation_state_payload = await _touch_state(
                     "order_flow",
-                    category=infer_state_category(query_text),
+                    category=query_category,
                     selected_product=selected_product_state,
                     preserve_selected_product=False,
                     last_handler_used="order_flow",
                     reset_loop=True,
+                    commit=False,
                 )
                 reply_text = "حتماً 🙂 برای ثبت سفارش، لطفاً سایز/رنگ و تعداد مدنظرتون رو بگید."
+                await log_event(
+                    session,
+                    level="info",
+                    event_type="selected_product_locked",
+                    data={
+                        "conversation_id": conversation.id,
+                        "user_id": user.id,
+                        "selected_product": selected_product_state,
+                    },
+                    commit=False,
+                )
                 await send_plan_and_store(
                     session,
                     conversation.id,
@@ -1896,47 +2254,16 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         "source": "order_flow",
                         "intent": "order_flow",
                         "handler": "order_flow",
-                        "product_id": selected_product_state.get("product_id")
-                        if isinstance(selected_product_state, dict)
-                        else None,
+                        "product_id": selected_product_state.get("product_id"),
                     }),
-                )
-                await log_event(
-                    session,
-                    level="info",
-                    event_type="selected_product_locked",
-                    data={
-                        "conversation_id": conversation.id,
-                        "user_id": user.id,
-                        "selected_product": selected_product_state,
-                    },
+                    state=state,
                 )
                 return
 
-            store_info_intent = router_intent == "store_info"
-            if not store_info_intent:
-                store_info_intent = (
-                    wants_contact(lowered)
-                    or wants_website(lowered)
-                    or wants_address(lowered)
-                    or wants_hours(lowered)
-                    or wants_phone(lowered)
-                    or wants_trust(lowered)
-                )
+            # store_topic_hit is the first of the store-info tags found this turn.
+            store_info_intent = router_intent == "store_info" or store_topic_hit is not None
             if store_info_intent:
-                store_topic = None
-                if wants_contact(lowered):
-                    store_topic = "contact"
-                elif wants_hours(lowered):
-                    store_topic = "hours"
-                elif wants_address(lowered):
-                    store_topic = "address"
-                elif wants_phone(lowered):
-                    store_topic = "phone"
-                elif wants_website(lowered):
-                    store_topic = "website"
-                elif wants_trust(lowered):
-                    store_topic = "trust"
+                store_topic = store_topic_hit
                 rule_plan = build_rule_based_plan(
                     normalized.message_type,
                     intent_text,
@@ -1945,9 +2272,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 if rule_plan:
                     conversation_state_payload = await _touch_state(
                         "store_info",
-                        category=infer_state_category(query_text),
+                        category=query_category,
                         last_handler_used="store_info",
                         reset_loop=True,
+                        commit=False,
                     )
                     await send_plan_and_store(
                         session,
@@ -1960,15 +2288,17 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "handler": "store_info",
                             "store_topic": store_topic,
                         }),
+                        state=state,
                     )
                     return
 
             if llm_first_all:
-                token_count = len(intent_text.split()) if intent_text else 0
-                if is_thanks(lowered) and token_count <= 4:
+                token_count = turn_text.intent_tokens
+                if "thanks" in lowered_hits and token_count <= 4:
                     conversation_state_payload = await _touch_state(
                         "unknown",
-                        category=infer_state_category(query_text),
+                        category=query_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -1976,12 +2306,14 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         build_thanks_response(),
                         meta=_merge_meta({"source": "guardrails", "intent": "thanks"}),
+                        state=state,
                     )
                     return
-                if is_decline(lowered) and token_count <= 6:
+                if "decline" in lowered_hits and token_count <= 6:
                     conversation_state_payload = await _touch_state(
                         "unknown",
-                        category=infer_state_category(query_text),
+                        category=query_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -1989,12 +2321,14 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         build_decline_response(),
                         meta=_merge_meta({"source": "guardrails", "intent": "decline"}),
+                        state=state,
                     )
                     return
-                if is_goodbye(lowered) and token_count <= 4:
+                if "goodbye" in lowered_hits and token_count <= 4:
                     conversation_state_payload = await _touch_state(
                         "unknown",
-                        category=infer_state_category(query_text),
+                        category=query_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -2002,12 +2336,14 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         build_goodbye_response(),
                         meta=_merge_meta({"source": "guardrails", "intent": "goodbye"}),
+                        state=state,
                     )
                     return
-                if is_greeting(lowered) and token_count <= 2:
+                if "greeting" in lowered_hits and token_count <= 2:
                     conversation_state_payload = await _touch_state(
                         "unknown",
-                        category=infer_state_category(query_text),
+                        category=query_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -2015,22 +2351,25 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         _build_personalized_greeting(user),
                         meta=_merge_meta({"source": "guardrails", "intent": "greeting"}),
+                        state=state,
                     )
                     return
 
             continue_request = wants_more_products(intent_text)
-            profile = user.profile_json if isinstance(user.profile_json, dict) else {}
-            prefs = profile.get("prefs") if isinstance(profile, dict) else None
+            profile, prefs = _profile_snapshot(user)
             if continue_request:
-                state = profile.get("product_state") if isinstance(profile, dict) else None
-                state_query = state.get("query") if isinstance(state, dict) else None
-                state_offset = state.get("offset") if isinstance(state, dict) else None
-                state_updated = state.get("updated_at") if isinstance(state, dict) else None
+                product_state = profile.get("product_state")
+                if not isinstance(product_state, dict):
+                    product_state = {}
+                state_query = product_state.get("query")
+                state_offset = product_state.get("offset")
+                state_updated = product_state.get("updated_at")
                 updated_at = parse_timestamp(state_updated) if isinstance(state_updated, str) else None
                 if not state_query or state_offset is None:
                     conversation_state_payload = await _touch_state(
                         "product_search",
-                        category=infer_state_category(query_text),
+                        category=query_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -2038,12 +2377,15 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         "برای ادامه لطفاً بگید دنبال چه محصولی بودید.",
                         meta=_merge_meta({"source": "product_match", "intent": "product_more_empty"}),
+                        state=state,
                     )
                     return
+                continue_category = infer_state_category(state_query)
                 if updated_at and (utc_now() - updated_at).total_seconds() > settings.PRODUCT_CONTINUE_TTL_SEC:
                     conversation_state_payload = await _touch_state(
                         "product_search",
-                        category=infer_state_category(state_query),
+                        category=continue_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -2051,25 +2393,25 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         "از آخرین لیست زمان گذشته؛ لطفاً دوباره بگید دنبال چه محصولی هستید.",
                         meta=_merge_meta({"source": "product_match", "intent": "product_more_expired"}),
+                        state=state,
                     )
                     return
-                matches = await match_products_with_scores(
-                    session,
-                    state_query,
-                    limit=max(
-                        settings.LLM_PRODUCT_CONTEXT_LIMIT,
-                        settings.PRODUCT_MATCH_LIMIT + int(state_offset),
-                    ),
-                )
-                products = [match.product for match in matches]
-                products = _rank_products_by_prefs(products, prefs)
                 start = int(state_offset)
                 end = start + settings.PRODUCT_MATCH_LIMIT
+                # One extra item is enough to know whether another page exists.
+                matches = await _match_products(
+                    state_query,
+                    max(settings.LLM_PRODUCT_CONTEXT_LIMIT, end + 1),
+                )
+                products = _rank_products_by_prefs(
+                    [match.product for match in matches], prefs, top_k=end + 1
+                )
                 page = products[start:end]
                 if not page:
                     conversation_state_payload = await _touch_state(
                         "product_search",
-                        category=infer_state_category(state_query),
+                        category=continue_category,
+                        commit=False,
                     )
                     await send_and_store(
                         session,
@@ -2077,14 +2419,17 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         "مورد بیشتری پیدا نکردم. اگر مدل خاصی مدنظرتونه بفرستید.",
                         meta=_merge_meta({"source": "product_match", "intent": "product_more_done"}),
+                        state=state,
                     )
                     return
                 product_plan = build_product_plan(state_query, page)
                 if product_plan:
                     conversation_state_payload = await _touch_state(
                         "product_search",
-                        category=infer_state_category(state_query),
+                        category=continue_category,
+                        commit=False,
                     )
+                    page_ids, page_slugs = _product_refs(page)
                     await send_plan_and_store(
                         session,
                         conversation.id,
@@ -2093,11 +2438,14 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         meta=_merge_meta({
                             "source": "product_match",
                             "intent": "product_more",
-                            "product_ids": [product.id for product in page],
-                            "product_slugs": [product.slug for product in page if product.slug],
+                            "product_ids": page_ids,
+                            "product_slugs": page_slugs,
                         }),
+                        state=state,
+                        # Written by _update_product_state's commit below.
+                        commit=False,
                     )
-                await _update_product_state(session, user, state_query, end, len(products))
+                await _update_product_state(session, user, state_query, end, len(matches))
                 if len(products) > end:
                     await send_plan_and_store(
                         session,
@@ -2108,6 +2456,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "source": "product_match",
                             "intent": "product_more_prompt",
                         }),
+                        state=state,
                     )
                 return
 
@@ -2115,26 +2464,12 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
             if query_text:
                 pref_updates = extract_preferences(query_text)
                 if pref_updates:
-                    profile = user.profile_json or {}
-                    prefs = profile.get("prefs", {}) if isinstance(profile, dict) else {}
-                    changed = False
-                    for key, value in pref_updates.items():
-                        if value is None:
-                            continue
-                        if isinstance(value, list):
-                            existing = prefs.get(key, [])
-                            merged = list(dict.fromkeys((existing or []) + value))
-                            if merged != existing:
-                                prefs[key] = merged
-                                changed = True
-                        else:
-                            if prefs.get(key) != value:
-                                prefs[key] = value
-                                changed = True
-                    if changed:
+                    merged_prefs = _merge_pref_values(prefs, pref_updates)
+                    if merged_prefs != prefs:
+                        # Persisted with the turn's next commit (state update or reply).
+                        prefs = merged_prefs
                         profile["prefs"] = prefs
                         user.profile_json = profile
-                        await session.commit()
 
             order_intent = bool(behavior_match and behavior_match.pattern == "ready_to_buy")
             if router_intent == "order_intent":
@@ -2146,7 +2481,8 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 order_intent = True
                 conversation_state_payload = await _touch_state(
                     "order_flow",
-                    category=infer_state_category(query_text),
+                    category=query_category,
+                    commit=False,
                 )
                 await send_plan_and_store(
                     session,
@@ -2154,6 +2490,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     normalized.sender_id,
                     order_plan,
                     meta=_merge_meta({"source": "order_flow", "intent": "order_flow"}),
+                    state=state,
                 )
                 await schedule_followup_task(
                     session,
@@ -2187,9 +2524,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 await session.commit()
                 conversation_state_payload = await _touch_state(
                     "support",
-                    category=infer_state_category(query_text),
+                    category=query_category,
                     last_handler_used="complaint_support",
                     reset_loop=True,
+                    commit=False,
                 )
                 await send_and_store(
                     session,
@@ -2202,27 +2540,24 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         "handler": "complaint_support",
                         "ticket_id": ticket.id,
                     }),
+                    state=state,
                 )
                 return
 
-            url_slug = _extract_product_slug(intent_text)
-            product_from_url: Product | None = None
-            if url_slug:
-                result = await session.execute(
-                    select(Product).where(
-                        (Product.slug == url_slug)
-                        | Product.page_url.ilike(f"%/product/{url_slug}%")
-                    )
-                )
-                product_from_url = result.scalars().first()
-
             tokens = tokenize_query(query_text)
             query_tags = infer_tags(query_text)
             wants_products = wants_product_list(query_text)
             needs_details = needs_product_details(query_text)
             visual_product_intent = bool(normalized.media_url and analysis_text)
-            store_intent = store_info_intent or is_greeting(lowered)
+            store_intent = store_info_intent or "greeting" in lowered_hits
             product_intent = wants_product_intent(query_text)
+            has_core_tag = bool(
+                query_tags.categories
+                or query_tags.genders
+                or query_tags.materials
+                or query_tags.styles
+            )
+            has_any_tag = has_core_tag or bool(query_tags.colors or query_tags.sizes)
             if store_intent or support_intent:
                 product_intent = False
             if selected_product_state:
@@ -2230,12 +2565,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 needs_details = False
             elif visual_product_intent:
                 product_intent = True
-            elif (
-                query_tags.categories
-                or query_tags.genders
-                or query_tags.materials
-                or query_tags.styles
-            ):
+            elif has_core_tag:
                 product_intent = True
 
             should_match_products = bool(query_text) and (
@@ -2243,21 +2573,15 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 or wants_products
                 or needs_details
                 or visual_product_intent
-                or query_tags.categories
-                or query_tags.genders
-                or query_tags.materials
-                or query_tags.styles
-                or query_tags.colors
-                or query_tags.sizes
+                or has_any_tag
             )
             if product_from_url:
                 should_match_products = True
             matches_for_context = []
             if should_match_products and not product_from_url:
-                matches_for_context = await match_products_with_scores(
-                    session,
+                matches_for_context = await _match_products(
                     query_text,
-                    limit=max(
+                    max(
                         settings.LLM_PRODUCT_CONTEXT_LIMIT,
                         settings.PRODUCT_MATCH_LIMIT,
                     ),
@@ -2269,10 +2593,9 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 matched_products_for_llm = [product_from_url]
                 matched_products = [product_from_url]
             if should_match_products and not matched_products_for_llm and analysis_text:
-                visual_matches = await match_products_with_scores(
-                    session,
+                visual_matches = await _match_products(
                     analysis_text,
-                    limit=max(
+                    max(
                         settings.LLM_PRODUCT_CONTEXT_LIMIT,
                         settings.PRODUCT_MATCH_LIMIT,
                     ),
@@ -2284,44 +2607,37 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     matched_products = matched_products_for_llm[: settings.PRODUCT_MATCH_LIMIT]
             more_results_available = len(matched_products_for_llm) > len(matched_products)
 
-            is_plain_list_request = wants_products and not (
-                query_tags.categories
-                or query_tags.genders
-                or query_tags.materials
-                or query_tags.styles
-                or query_tags.colors
-                or query_tags.sizes
-            )
+            is_plain_list_request = wants_products and not has_any_tag
             if wants_products and not matched_products_for_llm and is_plain_list_request:
+                # Sync bookkeeping columns are never read on the reply path.
                 result = await session.execute(
                     select(Product)
+                    .options(defer(Product.source_flags), defer(Product.lastmod))
                     .order_by(Product.updated_at.desc())
                     .limit(settings.LLM_PRODUCT_CONTEXT_LIMIT)
                 )
                 matched_products_for_llm = list(result.scalars().all())
                 matched_products = matched_products_for_llm[: settings.PRODUCT_MATCH_LIMIT]
 
-            prefs = None
-            if isinstance(user.profile_json, dict):
-                prefs = user.profile_json.get("prefs")
-            prefs_current = _merge_pref_values(prefs, pref_updates)
+            # prefs already carries this turn's pref_updates.
+            pref_scores: dict[int, int] = {}
             matched_products_for_llm = _rank_products_by_prefs(
-                matched_products_for_llm, prefs_current
+                matched_products_for_llm, prefs, score_cache=pref_scores
             )
-            matched_products = _rank_products_by_prefs(matched_products, prefs_current)
-            matched_product_ids = [product.id for product in matched_products]
-            matched_product_slugs = [product.slug for product in matched_products if product.slug]
-            query_tags_meta = {
-                "categories": list(query_tags.categories),
-                "genders": list(query_tags.genders),
-                "styles": list(query_tags.styles),
-                "materials": list(query_tags.materials),
-                "colors": list(query_tags.colors),
-                "sizes": list(query_tags.sizes),
+            matched_products = _rank_products_by_prefs(
+                matched_products, prefs, score_cache=pref_scores
+            )
+            matched_product_ids, matched_product_slugs = _product_refs(matched_products)
+            query_tags_meta = {field: list(getattr(query_tags, field)) for field in _TAG_FIELDS}
+            # Shared by every reply meta that reports this turn's match results.
+            match_meta = {
+                "product_ids": matched_product_ids,
+                "product_slugs": matched_product_slugs,
+                "match_debug": match_debug,
+                "query_tags": query_tags_meta,
             }
             if should_match_products:
-                await log_event(
-                    session,
+                emit_event(
                     level="info",
                     event_type="product_matched",
                     data={
@@ -2330,52 +2646,30 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         "query": query_text,
                         "matched_count": len(matched_products_for_llm),
                         "suggest_count": len(matched_products),
-                        "product_ids": matched_product_ids,
-                        "product_slugs": matched_product_slugs,
-                        "query_tags": query_tags_meta,
-                        "match_debug": match_debug,
+                        **match_meta,
                     },
-                    commit=False,
                 )
-                await session.commit()
 
             confidence_ok = True
-            low_confidence = False
-            if product_intent or needs_details or wants_products:
-                if product_from_url:
-                    confidence_ok = True
-                else:
-                    top_match = matches_for_context[0] if matches_for_context else None
-                    if not top_match:
-                        confidence_ok = False
-                    else:
-                        if tokens:
-                            required_score = max(2, len(tokens))
-                            if len(tokens) >= 3:
-                                required_score = max(3, len(tokens))
-                            confidence_ok = top_match.score >= required_score
-                        else:
-                            confidence_ok = top_match.score >= 2
-                if (
-                    not tokens
-                    and matches_for_context
-                    and (
-                        query_tags.categories
-                        or query_tags.genders
-                        or query_tags.materials
-                        or query_tags.styles
-                        or query_tags.colors
-                        or query_tags.sizes
-                    )
-                ):
-                    confidence_ok = True
-                low_confidence = not confidence_ok
+            if (product_intent or needs_details or wants_products) and not product_from_url:
+                confidence_ok = _match_confidence(
+                    matches_for_context[0].score if matches_for_context else None,
+                    len(tokens),
+                    has_any_tag,
+                )
+            low_confidence = not confidence_ok
+            # Shared by the LLM reply and the product cards that may follow it.
+            answer_meta = {
+                **match_meta,
+                "confidence_ok": confidence_ok,
+                "llm_first": llm_first_all,
+            }
 
             if (
                 not selected_product_state
                 and confidence_ok
                 and matched_products
-                and router_intent in {"product_specific", "price_availability"}
+                and router_intent in _PRODUCT_LOCK_INTENTS
             ):
                 selected_product_state = build_selected_product_payload(matched_products[0])
                 await log_event(
@@ -2390,7 +2684,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     },
                     commit=False,
                 )
-                await session.commit()
 
             required_fields: list[str] = []
             required_known: dict[str, str] = {}
@@ -2416,34 +2709,28 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
             low_confidence_block = bool(required_fields)
             confidence_for_cards = confidence_ok and not low_confidence_block
 
-            prefs_snapshot = _merge_pref_values(prefs_current, pref_updates)
-            filled_slots = _build_filled_slots(query_tags, prefs_snapshot, pref_updates)
+            filled_slots = _build_filled_slots(query_tags, prefs)
             state_intent = infer_state_intent(
                 intent_text,
                 product_intent=product_intent,
                 support_intent=support_intent,
                 order_intent=order_intent,
             )
-            if router_intent == "store_info":
-                state_intent = "store_info"
-            elif router_intent == "complaint_support":
-                state_intent = "support"
-            elif router_intent == "order_intent":
-                state_intent = "order_flow"
-            elif router_intent == "product_link_request" and selected_product_state:
-                state_intent = "product_selected"
+            # A locked product outranks whatever the router said.
             if selected_product_state:
                 state_intent = "product_selected"
+            else:
+                state_intent = _ROUTER_STATE_INTENTS.get(router_intent, state_intent)
             state_category = (
                 router_category
                 if router_category and router_category != "unknown"
-                else infer_state_category(query_text)
+                else query_category
             )
             state_required_slots = required_fields if required_fields else None
             allow_generic_slots = bool(
                 state_intent == "product_search"
-                and state_category in {"shoes", "apparel"}
-                and any(field in {"gender", "size", "style", "budget"} for field in required_fields)
+                and state_category in _GENERIC_SLOT_CATEGORIES
+                and any(field in _GENERIC_SLOT_FIELDS for field in required_fields)
             )
             if selected_product_state:
                 allow_generic_slots = False
@@ -2451,9 +2738,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 user.profile_json if isinstance(user.profile_json, dict) else None,
                 user_text=intent_text,
                 matched_products=matched_products_for_llm,
-                selected_product=selected_product_state
-                if isinstance(selected_product_state, dict)
-                else None,
+                selected_product=selected_product_state,
             )
             if memory_changed:
                 user.profile_json = remembered_profile
@@ -2463,9 +2748,9 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 required_slots=state_required_slots,
                 filled_slots=filled_slots,
                 selected_product=selected_product_state,
+                commit=False,
             )
-            await log_event(
-                session,
+            emit_event(
                 level="info",
                 event_type="intent_detected",
                 data={
@@ -2479,7 +2764,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     "router_evidence": router_evidence,
                     "router_risk": router_risk,
                 },
-                commit=False,
             )
             if required_fields:
                 await log_event(
@@ -2494,7 +2778,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     },
                     commit=False,
                 )
-            await session.commit()
 
             if (
                 matched_products
@@ -2508,47 +2791,60 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     required_question_text
                     or "برای معرفی دقیق‌تر، لطفاً جنسیت، سایز، سبک (رسمی/اسپرت) و بازه قیمت رو بگید.",
                     meta=_merge_meta({
+                        **match_meta,
                         "source": "product_match",
                         "intent": "need_details",
-                        "product_ids": matched_product_ids,
-                        "product_slugs": matched_product_slugs,
                         "confidence_ok": False,
-                        "match_debug": match_debug,
-                        "query_tags": query_tags_meta,
                     }),
+                    state=state,
                 )
                 return
 
+            plan_cache: list[tuple[OutboundPlan | None, list[int], list[str]]] = []
+
+            async def _plan_for_matches() -> tuple[OutboundPlan | None, list[int], list[str]]:
+                # The card shortcut and the post-LLM path build the same plan;
+                # the cross-sell lookup should only run once per turn.
+                if not plan_cache:
+                    cross_sell_allowed = bool(
+                        (order_intent or (behavior_match and behavior_match.pattern == "ready_to_buy"))
+                        and confidence_ok
+                        and not low_confidence_block
+                    )
+                    products = await _maybe_add_cross_sell(
+                        session,
+                        user,
+                        matched_products,
+                        allow=cross_sell_allowed,
+                    )
+                    # Without a cross-sell the refs are the ones already built for matching.
+                    if products is matched_products:
+                        plan_ids, plan_slugs = matched_product_ids, matched_product_slugs
+                    else:
+                        plan_ids, plan_slugs = _product_refs(products)
+                    plan_cache.append((build_product_plan(query_text, products), plan_ids, plan_slugs))
+                return plan_cache[0]
+
             if matched_products and not store_intent and (confidence_for_cards or is_plain_list_request):
-                cross_sell_allowed = bool(
-                    (order_intent or (behavior_match and behavior_match.pattern == "ready_to_buy"))
-                    and confidence_ok
-                    and not low_confidence_block
-                )
-                products_for_plan = await _maybe_add_cross_sell(
-                    session,
-                    user,
-                    matched_products,
-                    allow=cross_sell_allowed,
-                )
-                product_plan = build_product_plan(query_text, products_for_plan)
+                product_plan, plan_ids, plan_slugs = await _plan_for_matches()
                 if product_plan:
-                    plan_ids = [product.id for product in products_for_plan]
-                    plan_slugs = [product.slug for product in products_for_plan if product.slug]
                     await send_plan_and_store(
                         session,
                         conversation.id,
                         normalized.sender_id,
                         product_plan,
                         meta=_merge_meta({
+                            **match_meta,
                             "source": "product_match",
                             "intent": "product_suggest",
                             "product_ids": plan_ids,
                             "product_slugs": plan_slugs,
                             "confidence_ok": confidence_ok,
-                            "match_debug": match_debug,
-                            "query_tags": query_tags_meta,
                         }),
+                        state=state,
+                        # The cards and the "more" prompt are written by
+                        # _update_product_state's commit below.
+                        commit=False,
                     )
                     if _should_schedule_followup(
                         behavior_match,
@@ -2575,6 +2871,8 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                                 "product_ids": matched_product_ids,
                                 "product_slugs": matched_product_slugs,
                             }),
+                            state=state,
+                            commit=False,
                         )
                     await _update_product_state(
                         session,
@@ -2591,20 +2889,16 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     normalized.sender_id,
                     "برای معرفی دقیق‌تر، لطفاً جنسیت، سایز، سبک (رسمی/اسپرت) و بازه قیمت رو بگید؛ اگر مدل خاصی دارید اسم یا عکسش رو بفرستید.",
                     meta=_merge_meta({"source": "product_match", "intent": "no_match"}),
+                    state=state,
                 )
                 return
 
             if not llm_first_all:
                 if (intent_text or analysis_text) and _is_low_signal(intent_text or analysis_text):
                     if not (
-                        is_greeting(lowered)
-                        or wants_products
+                        wants_products
                         or needs_details
-                        or wants_website(lowered)
-                        or wants_address(lowered)
-                        or wants_hours(lowered)
-                        or wants_phone(lowered)
-                        or wants_trust(lowered)
+                        or lowered_hits & _LOW_SIGNAL_EXEMPT_TAGS
                     ):
                         await send_and_store(
                             session,
@@ -2612,6 +2906,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             normalized.sender_id,
                             fallback_for_message_type("text"),
                             meta=_merge_meta({"source": "guardrails", "intent": "low_signal"}),
+                            state=state,
                         )
                         return
 
@@ -2627,6 +2922,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         normalized.sender_id,
                         rule_plan,
                         meta=_merge_meta({"source": "guardrails", "intent": "rule_based"}),
+                        state=state,
                     )
                     return
 
@@ -2635,7 +2931,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 user.vip_score = current_score + 1
                 if user.vip_score >= settings.VIP_SCORE_THRESHOLD:
                     user.is_vip = True
-                await session.commit()
                 if user.is_vip and current_score < settings.VIP_SCORE_THRESHOLD:
                     await log_event(
                         session,
@@ -2646,9 +2941,12 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "conversation_id": conversation.id,
                             "vip_score": user.vip_score,
                         },
+                        commit=False,
                     )
 
-                faqs = await get_verified_faqs(session)
+                faqs = await _cached_prompt_context(
+                    "faqs", lambda: _read_in_own_session(get_verified_faqs)
+                )
                 if normalized.text and faqs:
                     faq_answer = match_faq(normalized.text, faqs)
                     if faq_answer:
@@ -2658,52 +2956,40 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             normalized.sender_id,
                             faq_answer,
                             meta=_merge_meta({"source": "faq", "intent": "faq_match"}),
+                            state=state,
                         )
                         return
             else:
-                faqs = await get_verified_faqs(session)
+                faqs = await _cached_prompt_context(
+                    "faqs", lambda: _read_in_own_session(get_verified_faqs)
+                )
 
-            campaigns = await get_active_campaigns(session)
-            policy_memory_items = await get_admin_policy_memory(session, limit=10)
-            llm_products = matched_products_for_llm if should_match_products else []
-            response_logs = await get_recent_response_logs(
-                session,
-                conversation.id,
-                settings.RESPONSE_LOG_CONTEXT_LIMIT,
+            campaigns, policy_memory_items, response_logs = await asyncio.gather(
+                _cached_prompt_context(
+                    "campaigns", lambda: _read_in_own_session(get_active_campaigns)
+                ),
+                _cached_prompt_context(
+                    "policy_memory",
+                    lambda: _read_in_own_session(get_admin_policy_memory, limit=10),
+                ),
+                _read_in_own_session(
+                    get_recent_response_logs,
+                    conversation.id,
+                    settings.RESPONSE_LOG_CONTEXT_LIMIT,
+                ),
             )
+            # Cached rows may outlive a campaign's end while the TTL runs.
+            now = utc_now()
+            campaigns = [
+                campaign
+                for campaign in campaigns
+                if campaign.end_at is None or campaign.end_at >= now
+            ]
+            llm_products = matched_products_for_llm if should_match_products else []
             response_log_summary = build_response_log_summary(response_logs)
             system_notes: list[str] = []
             if analysis_text:
-                detail_lines = [analysis_text]
-                if analysis_payload:
-                    attrs = analysis_payload.get("attributes") or {}
-                    if isinstance(attrs, dict):
-                        attr_bits = [
-                            f"{key}:{value}"
-                            for key, value in attrs.items()
-                            if isinstance(value, str) and value.strip()
-                        ]
-                        if attr_bits:
-                            detail_lines.append("مشخصات: " + "، ".join(attr_bits))
-                    tags = analysis_payload.get("tags") or {}
-                    if isinstance(tags, dict):
-                        tag_bits = []
-                        for key in ("categories", "genders", "styles", "materials", "colors", "sizes"):
-                            values = tags.get(key)
-                            if isinstance(values, list) and values:
-                                tag_bits.append(f"{key}={', '.join(str(v) for v in values)}")
-                        if tag_bits:
-                            detail_lines.append("برچسب‌ها: " + " | ".join(tag_bits))
-                    search_terms = analysis_payload.get("search_terms")
-                    if isinstance(search_terms, list):
-                        term_bits = [
-                            str(term).strip()
-                            for term in search_terms
-                            if isinstance(term, str) and str(term).strip()
-                        ]
-                        if term_bits:
-                            detail_lines.append("کلیدواژه‌ها: " + " | ".join(term_bits[:8]))
-                system_notes.append("[IMAGE_ANALYSIS]\n" + "\n".join(detail_lines))
+                system_notes.append(_format_analysis_notes(analysis_text, analysis_payload))
             if order_hint_text:
                 system_notes.append(
                     "[ORDER_FLOW]\n"
@@ -2742,7 +3028,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 conversation_state=conversation_state_payload,
                 response_log_summary=response_log_summary,
                 system_notes=system_notes,
-                admin_notes=bot_settings.admin_notes if bot_settings else None,
+                admin_notes=admin_notes,
                 allow_product_cards=allow_product_cards,
             )
             await log_event(
@@ -2760,21 +3046,41 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 },
                 commit=False,
             )
+            # Everything staged since the match stage is written here, once,
+            # so no transaction stays open across the LLM call.
             await session.commit()
 
-            provider = choose_provider(
-                normalized, bot_settings.ai_mode if bot_settings else None
-            )
+            provider = choose_provider(normalized, ai_mode)
             logger.info("provider_selected", provider=provider)
-            await log_event(
-                session,
+            emit_event(
                 level="info",
                 event_type="provider_selected",
                 data={"provider": provider, "sender_id": normalized.sender_id},
-                commit=False,
             )
             start_time = time.monotonic()
             provider_used = None
+            contextual_cache: list[str] = []
+
+            def _contextual_reply() -> str:
+                # Post-processing, the LLM error path, the empty-reply guard and
+                # the generic-reply rewrite all fall back to the same text.
+                if not contextual_cache:
+                    contextual_cache.append(
+                        _build_contextual_reply(
+                            user=user,
+                            query_text=query_text,
+                            analysis_text=analysis_text,
+                            matched_products=matched_products,
+                            wants_products=wants_products,
+                            needs_details=needs_details,
+                        )
+                    )
+                return contextual_cache[0]
+
+            def _fallback_reply() -> str:
+                if fallback_override:
+                    return fallback_override
+                return _contextual_reply()
 
             try:
                 reply_text, usage, provider_used = await generate_with_fallback(
@@ -2786,32 +3092,16 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     provider=provider_used,
                     latency_ms=latency_ms,
                 )
-                await log_event(
-                    session,
+                emit_event(
                     level="info",
                     event_type="llm_latency",
                     data={"provider": provider_used, "latency_ms": latency_ms},
-                    commit=False,
-                )
-                max_chars = (
-                    bot_settings.max_output_chars
-                    if bot_settings and bot_settings.max_output_chars
-                    else settings.MAX_RESPONSE_CHARS
                 )
-                fallback_text = (
-                    bot_settings.fallback_text
-                    if bot_settings and bot_settings.fallback_text
-                    else _build_contextual_reply(
-                        user=user,
-                        query_text=query_text,
-                        analysis_text=analysis_text,
-                        matched_products=matched_products,
-                        wants_products=wants_products,
-                        needs_details=needs_details,
-                    )
+                reply_text = post_process(
+                    reply_text, max_chars=max_chars, fallback_text=_fallback_reply()
                 )
-                reply_text = post_process(reply_text, max_chars=max_chars, fallback_text=fallback_text)
-                await record_usage(session, usage, provider_used)
+                # Committed together with the reply once it is sent.
+                await record_usage(session, usage, provider_used, commit=False)
             except LLMError as exc:
                 latency_ms = int((time.monotonic() - start_time) * 1000)
                 logger.error(
@@ -2826,19 +3116,9 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     event_type="llm_error",
                     message=str(exc),
                     data={"latency_ms": latency_ms},
+                    commit=False,
                 )
-                reply_text = (
-                    bot_settings.fallback_text
-                    if bot_settings and bot_settings.fallback_text
-                    else _build_contextual_reply(
-                        user=user,
-                        query_text=query_text,
-                        analysis_text=analysis_text,
-                        matched_products=matched_products,
-                        wants_products=wants_products,
-                        needs_details=needs_details,
-                    )
-                )
+                reply_text = _fallback_reply()
 
             show_products = False
             auto_show_products = allow_product_cards
@@ -2870,10 +3150,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 settings.LLM_STRICT_PRICE_GROUNDING
                 and (product_intent or needs_details or wants_products or selected_product_state)
             ):
-                selected_payload = (
-                    selected_product_state if isinstance(selected_product_state, dict) else None
-                )
-                allowed_prices = _allowed_price_values(llm_products, selected_payload)
+                allowed_prices = _allowed_price_values(llm_products, selected_product_state)
                 if _reply_has_ungrounded_price(reply_text, allowed_prices):
                     reply_text = "برای اعلام قیمت دقیق، لطفاً اسم/مدل یا لینک همون محصول رو بفرستید."
                     show_products = False
@@ -2890,39 +3167,16 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         commit=False,
                     )
 
-            guardrail_blocked_products = False
             product_plan = None
-            products_for_plan = matched_products
+            plan_ids, plan_slugs = matched_product_ids, matched_product_slugs
             if show_products and matched_products:
-                cross_sell_allowed = bool(
-                    (order_intent or (behavior_match and behavior_match.pattern == "ready_to_buy"))
-                    and confidence_ok
-                    and not low_confidence_block
-                )
-                products_for_plan = await _maybe_add_cross_sell(
-                    session,
-                    user,
-                    matched_products,
-                    allow=cross_sell_allowed,
-                )
-                product_plan = build_product_plan(query_text, products_for_plan)
+                product_plan, plan_ids, plan_slugs = await _plan_for_matches()
 
             if show_products and not reply_text:
                 reply_text = "چند پیشنهاد مرتبط برات آماده کردم:"
 
             if not reply_text:
-                reply_text = (
-                    bot_settings.fallback_text
-                    if bot_settings and bot_settings.fallback_text
-                    else _build_contextual_reply(
-                        user=user,
-                        query_text=query_text,
-                        analysis_text=analysis_text,
-                        matched_products=matched_products,
-                        wants_products=wants_products,
-                        needs_details=needs_details,
-                    )
-                )
+                reply_text = _fallback_reply()
 
             if reply_text:
                 rewrite_reasons: list[str] = []
@@ -2933,11 +3187,9 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     or needs_details
                 )
                 max_questions = 1 if allow_question else 0
-                reply_text = _limit_questions(reply_text, max_questions)
-                reply_text = _limit_sentences(
-                    reply_text, settings.MAX_RESPONSE_SENTENCES
+                reply_text = _limit_reply(
+                    reply_text, max_questions, settings.MAX_RESPONSE_SENTENCES, 1
                 )
-                reply_text = _limit_emojis(reply_text, 1)
                 if normalized.media_url and _looks_like_image_blind_reply(reply_text):
                     rewrite_reasons.append("image_blind_reply_rewritten")
                     if matched_products:
@@ -2947,14 +3199,7 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         reply_text = "تصویر دریافت شد. برای اعلام دقیق قیمت و موجودی، اسم مدل یا رنگ مدنظرتون رو بفرستید."
                 if _looks_like_generic_assistant_reply(reply_text):
                     rewrite_reasons.append("generic_reply_rewritten")
-                    reply_text = _build_contextual_reply(
-                        user=user,
-                        query_text=query_text,
-                        analysis_text=analysis_text,
-                        matched_products=matched_products,
-                        wants_products=wants_products,
-                        needs_details=needs_details,
-                    )
+                    reply_text = _contextual_reply()
                     if allow_product_cards and matched_products:
                         show_products = True
                 loop_reference: str | None = None
@@ -2973,19 +3218,19 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         rewrite_reasons.append(loop_reason)
                     loop_payload = await _touch_state(
                         state.intent or "unknown",
-                        category=state.category or infer_state_category(query_text),
+                        category=state.category or query_category,
                         required_slots=state.slots_required,
                         filled_slots=state.slots_filled,
                         selected_product=selected_product_state,
                         preserve_selected_product=True,
                         last_handler_used="loop_detected",
                         increment_loop=True,
+                        commit=False,
                     )
                     loop_count = 0
                     if isinstance(loop_payload, dict):
                         loop_count = int(loop_payload.get("loop_counter") or 0)
-                    await log_event(
-                        session,
+                    emit_event(
                         level="info",
                         event_type="loop_detected",
                         data={
@@ -2996,7 +3241,6 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "reason": loop_reason,
                             "loop_counter": loop_count,
                         },
-                        commit=False,
                     )
                     if low_confidence_block and required_fields:
                         reply_text = _format_required_question_alt(required_fields, required_known)
@@ -3033,11 +3277,9 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         )
                         show_products = False
                         product_plan = None
-                    reply_text = _limit_questions(reply_text, max_questions)
-                    reply_text = _limit_sentences(
-                        reply_text, settings.MAX_RESPONSE_SENTENCES
+                    reply_text = _limit_reply(
+                        reply_text, max_questions, settings.MAX_RESPONSE_SENTENCES, 1
                     )
-                    reply_text = _limit_emojis(reply_text, 1)
                 guardrail_plan, guardrail_reasons = validate_reply_or_rewrite(
                     OutboundPlan(type="text", text=reply_text),
                     conversation_state_payload,
@@ -3049,13 +3291,10 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                 if guardrail_reasons:
                     rewrite_reasons.extend(guardrail_reasons)
 
-                rewrite_reasons = list(dict.fromkeys(rewrite_reasons))
+                rewrite_reasons, reason_events = _classify_guardrail_reasons(rewrite_reasons)
                 if rewrite_reasons:
-                    guardrail_blocked_products = any(
-                        reason.startswith(("link_request", "template_blocked", "hallucination_prevented"))
-                        for reason in rewrite_reasons
-                    )
-                    if guardrail_blocked_products:
+                    # The reasons reported as events are exactly the ones that block products.
+                    if reason_events:
                         show_products = False
                         product_plan = None
                     await log_event(
@@ -3070,67 +3309,29 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                         },
                         commit=False,
                     )
-                    for reason in rewrite_reasons:
-                        if reason.startswith("template_blocked"):
-                            await log_event(
-                                session,
-                                level="info",
-                                event_type="template_blocked",
-                                data={
-                                    "conversation_id": conversation.id,
-                                    "user_id": user.id,
-                                    "reason": reason,
-                                },
-                                commit=False,
-                            )
-                        elif reason.startswith("hallucination_prevented"):
-                            await log_event(
-                                session,
-                                level="info",
-                                event_type="hallucination_prevented",
-                                data={
-                                    "conversation_id": conversation.id,
-                                    "user_id": user.id,
-                                    "reason": reason,
-                                },
-                                commit=False,
-                            )
-                        elif reason.startswith("link_request"):
-                            await log_event(
-                                session,
-                                level="info",
-                                event_type="link_request_handled",
-                                data={
-                                    "conversation_id": conversation.id,
-                                    "user_id": user.id,
-                                    "reason": reason,
-                                },
-                                commit=False,
-                            )
-                    await session.commit()
+                    _emit_guardrail_reason_events(
+                        reason_events,
+                        {"conversation_id": conversation.id, "user_id": user.id},
+                    )
                 await send_and_store(
                     session,
                     conversation.id,
                     normalized.sender_id,
                     reply_text,
                     meta=_merge_meta({
+                        **answer_meta,
                         "source": "llm",
                         "intent": "llm",
                         "provider": provider_used,
                         "product_context_count": len(llm_products),
-                        "product_ids": matched_product_ids,
-                        "product_slugs": matched_product_slugs,
                         "catalog_used": bool(catalog_summary),
                         "response_logs_used": bool(response_log_summary),
-                        "llm_first": llm_first_all,
-                        "confidence_ok": confidence_ok,
                         "low_confidence": low_confidence,
                         "required_fields": required_fields,
                         "order_flow": bool(order_hint_text),
                         "show_products_token": show_products,
-                        "match_debug": match_debug,
-                        "query_tags": query_tags_meta,
                     }),
+                    state=state,
                 )
                 if order_hint_text and not product_plan:
                     await schedule_followup_task(
@@ -3142,26 +3343,21 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                     )
 
             if product_plan:
-                plan_ids = []
-                plan_slugs = []
-                if products_for_plan:
-                    plan_ids = [product.id for product in products_for_plan]
-                    plan_slugs = [product.slug for product in products_for_plan if product.slug]
                 await send_plan_and_store(
                     session,
                     conversation.id,
                     normalized.sender_id,
                     product_plan,
                     meta=_merge_meta({
+                        **answer_meta,
                         "source": "product_match",
                         "intent": "product_suggest",
                         "product_ids": plan_ids or matched_product_ids,
                         "product_slugs": plan_slugs or matched_product_slugs,
-                        "confidence_ok": confidence_ok,
-                        "llm_first": llm_first_all,
-                        "match_debug": match_debug,
-                        "query_tags": query_tags_meta,
                     }),
+                    state=state,
+                    # Written by _update_product_state's commit below.
+                    commit=False,
                 )
                 if _should_schedule_followup(
                     behavior_match,
@@ -3188,6 +3384,8 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
                             "product_ids": matched_product_ids,
                             "product_slugs": matched_product_slugs,
                         }),
+                        state=state,
+                        commit=False,
                     )
                 await _update_product_state(
                     session,
@@ -3202,28 +3400,46 @@ async def handle_webhook(payload: dict[str, Any]) -> None:
 
 
 async def upsert_user(session: AsyncSession, message: NormalizedMessage) -> User:
-    result = await session.execute(
-        select(User).where(User.external_id == message.sender_id)
-    )
-    user = result.scalars().first()
-    if user:
-        if message.username:
-            user.username = message.username
-        if message.follow_status:
-            user.follow_status = message.follow_status
-        if message.follower_count is not None:
-            user.follower_count = message.follower_count
-        return user
-
-    user = User(
+    # One round trip for a new user or a changed profile; empty values keep
+    # whatever is already stored.
+    stmt = insert(User).values(
         external_id=message.sender_id,
         username=message.username,
         follow_status=message.follow_status,
         follower_count=message.follower_count,
     )
-    session.add(user)
-    await session.flush()
-    return user
+    username = func.coalesce(func.nullif(stmt.excluded.username, ""), User.username)
+    follow_status = func.coalesce(
+        func.nullif(stmt.excluded.follow_status, ""), User.follow_status
+    )
+    follower_count = func.coalesce(stmt.excluded.follower_count, User.follower_count)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.external_id],
+        set_={
+            "username": username,
+            "follow_status": follow_status,
+            "follower_count": follower_count,
+            "updated_at": func.now(),
+        },
+        # Unchanged profiles are not rewritten, so updated_at keeps meaning
+        # "profile changed" and read receipts don't leave dead tuples.
+        where=or_(
+            User.username.is_distinct_from(username),
+            User.follow_status.is_distinct_from(follow_status),
+            User.follower_count.is_distinct_from(follower_count),
+        ),
+    ).returning(User)
+    result = await session.execute(
+        stmt, execution_options={"populate_existing": True}
+    )
+    user = result.scalars().first()
+    if user is not None:
+        return user
+    # The WHERE skipped the update, so RETURNING had no row to give back.
+    result = await session.execute(
+        select(User).where(User.external_id == message.sender_id)
+    )
+    return result.scalars().one()
 
 
 async def get_or_create_conversation(session: AsyncSession, user_id: int) -> Conversation:
@@ -3259,8 +3475,8 @@ async def save_message(
         media_url=message.media_url or message.audio_url,
         payload_json=message.raw_payload,
     )
+    # The id is assigned by the caller's commit; nothing reads it before then.
     session.add(record)
-    await session.flush()
     return record
 
 
@@ -3294,7 +3510,8 @@ async def get_recent_history(
     result = await session.execute(
         select(Message)
         .where(Message.conversation_id == conversation_id)
-        .order_by(Message.created_at.desc())
+        # Replies sent in one transaction share now(); id keeps their order.
+        .order_by(Message.created_at.desc(), Message.id.desc())
         .limit(limit)
     )
     messages = list(result.scalars().all())
@@ -3311,8 +3528,8 @@ async def get_recent_response_logs(
         return []
     result = await session.execute(
         select(AppLog)
+        .where(AppLog.conversation_id == conversation_id)
         .where(AppLog.event_type == "assistant_response")
-        .where(cast(AppLog.data["conversation_id"].astext, Integer) == conversation_id)
         .order_by(AppLog.created_at.desc())
         .limit(limit)
     )
@@ -3324,7 +3541,11 @@ async def get_recent_response_logs(
 def build_response_log_summary(logs: list[AppLog]) -> str | None:
     if not logs:
         return None
+    header = "[RECENT_RESPONSES]\n"
+    limit = settings.LLM_MESSAGE_MAX_CHARS
     lines: list[str] = []
+    # Stop once the joined summary would pass the limit; the rest is cut anyway.
+    length = len(header) - 1
     for log in logs:
         message = (log.message or "").strip()
         if not message:
@@ -3334,14 +3555,18 @@ def build_response_log_summary(logs: list[AppLog]) -> str | None:
         intent = data.get("intent")
         tag = source if not intent else f"{source}/{intent}"
         snippet = " ".join(message.split())
-        if len(snippet) > settings.LLM_MESSAGE_MAX_CHARS:
-            snippet = snippet[: settings.LLM_MESSAGE_MAX_CHARS].rstrip() + "..."
-        lines.append(f"- [{tag}] {snippet}")
+        if len(snippet) > limit:
+            snippet = snippet[:limit].rstrip() + "..."
+        line = f"- [{tag}] {snippet}"
+        lines.append(line)
+        length += len(line) + 1
+        if length > limit:
+            break
     if not lines:
         return None
-    summary = "[RECENT_RESPONSES]\n" + "\n".join(lines)
-    if len(summary) > settings.LLM_MESSAGE_MAX_CHARS:
-        summary = summary[: settings.LLM_MESSAGE_MAX_CHARS].rstrip() + "..."
+    summary = header + "\n".join(lines)
+    if len(summary) > limit:
+        summary = summary[:limit].rstrip() + "..."
     return summary
 
 
@@ -3350,16 +3575,33 @@ def _trim_history_for_llm(
 ) -> list[Message]:
     if max_user_turns <= 0:
         return history
-    trimmed: list[Message] = []
+    # Find where the last N user turns start and slice once, rather than
+    # copying messages one by one and reversing the copy.
     user_turns = 0
-    for msg in reversed(history):
-        trimmed.append(msg)
+    for index in range(len(history) - 1, -1, -1):
+        msg = history[index]
         if msg.role == "user" and msg.type != "read":
             user_turns += 1
             if user_turns >= max_user_turns:
-                break
-    trimmed.reverse()
-    return trimmed
+                return history[index:]
+    return history
+
+
+async def _cached_prompt_context(key: str, load: Callable[[], Awaitable[Any]]) -> Any:
+    ttl = settings.PROMPT_CONTEXT_TTL_SEC
+    cached = _PROMPT_CONTEXT_CACHE.get(key)
+    if ttl > 0 and cached and (time.monotonic() - cached[0]) < ttl:
+        return cached[1]
+    value = await load()
+    _PROMPT_CONTEXT_CACHE[key] = (time.monotonic(), value)
+    return value
+
+
+async def _read_in_own_session(reader: Any, *args: Any, **kwargs: Any) -> Any:
+    # An AsyncSession runs one statement at a time, so reads that should
+    # overlap each get a short-lived session of their own.
+    async with AsyncSessionLocal() as read_session:
+        return await reader(read_session, *args, **kwargs)
 
 
 async def get_verified_faqs(session: AsyncSession, limit: int = 30) -> list[Faq]:
@@ -3386,43 +3628,78 @@ async def get_active_campaigns(session: AsyncSession, limit: int = 5) -> list[Ca
     return list(result.scalars().all())
 
 
-def match_faq(text: str, faqs: list[Faq]) -> str | None:
-    normalized = text.strip().lower()
-    for faq in faqs:
-        if faq.question and faq.question.strip().lower() in normalized:
-            return faq.answer
-        if faq.tags:
-            for tag in faq.tags:
-                if tag and tag.strip().lower() in normalized and len(tag) >= FAQ_MATCH_MIN_LEN:
-                    return faq.answer
-    return None
+def _faq_classifier(faqs: list[Faq]) -> KeywordClassifier[int]:
+    global _FAQ_MATCHER_FAQS, _FAQ_MATCHER
+    # The prompt-context cache hands back the same list until its TTL runs
+    # out, so the matcher is rebuilt only when the FAQs are reloaded.
+    if _FAQ_MATCHER is None or _FAQ_MATCHER_FAQS is not faqs:
+        groups: dict[int, list[str]] = {}
+        for index, faq in enumerate(faqs):
+            keywords = [faq.question] if faq.question else []
+            for tag in faq.tags or []:
+                if tag and len(tag) >= FAQ_MATCH_MIN_LEN:
+                    keywords.append(tag)
+            groups[index] = keywords
+        _FAQ_MATCHER = KeywordClassifier(groups, normalize=_normalize_faq_text)
+        _FAQ_MATCHER_FAQS = faqs
+    return _FAQ_MATCHER
 
 
-def inject_campaigns_and_faqs(
-    messages: list[dict[str, str]],
-    campaigns: list[Campaign],
-    faqs: list[Faq],
-) -> list[dict[str, str]]:
-    additions: list[str] = []
-    if campaigns:
-        lines = []
-        for campaign in campaigns:
-            parts = [campaign.title, campaign.body]
-            if campaign.discount_code:
-                parts.append(f"کد تخفیف: {campaign.discount_code}")
-            if campaign.link:
-                parts.append(f"لینک: {campaign.link}")
-            lines.append(" | ".join(part for part in parts if part))
-        additions.append("کمپین‌های فعال:\n" + "\n".join(f"- {line}" for line in lines))
-    if faqs:
-        faq_lines = [
-            f"Q: {faq.question}\nA: {faq.answer}" for faq in faqs if faq.question and faq.answer
-        ]
-        if faq_lines:
-            additions.append("FAQ تاییدشده:\n" + "\n".join(faq_lines))
-    if not additions:
-        return messages
-    return messages + [{"role": "system", "content": "\n\n".join(additions)}]
+def _normalize_faq_text(value: str) -> str:
+    return value.strip().lower()
+
+
+def match_faq(text: str, faqs: list[Faq]) -> str | None:
+    hits = _faq_classifier(faqs).classify(text)
+    if not hits:
+        return None
+    # Earlier FAQs win, as with the old question-then-tags loop.
+    return faqs[min(hits)].answer
+
+
+def _product_context_line(product: Product) -> str:
+    # The line depends only on the product row.
+    key = row_version_key(product)
+    line = _PRODUCT_LINE_CACHE.get(key)
+    if line is not None:
+        return line
+    title = product.title or product.slug or "بدون عنوان"
+    price = str(product.price) if product.price is not None else "نامشخص"
+    old_price = str(product.old_price) if product.old_price is not None else None
+    availability = (
+        product.availability.value
+        if hasattr(product.availability, "value")
+        else str(product.availability)
+    )
+    product_tags = product_tag_info(product)
+    parts = [title, f"قیمت: {price}"]
+    if old_price:
+        parts.append(f"قبل: {old_price}")
+    parts.append(f"موجودی: {availability}")
+    if product.product_id:
+        parts.append(f"مدل: {product.product_id}")
+    if product_tags.categories:
+        parts.append(f"دسته: {', '.join(product_tags.categories)}")
+    if product_tags.genders:
+        parts.append(f"جنسیت: {', '.join(product_tags.genders)}")
+    if product_tags.materials:
+        parts.append(f"جنس: {', '.join(product_tags.materials)}")
+    if product_tags.styles:
+        parts.append(f"سبک: {', '.join(product_tags.styles)}")
+    if product_tags.colors:
+        parts.append(f"رنگ: {', '.join(product_tags.colors[:3])}")
+    if product.description:
+        description = " ".join(product.description.split())
+        if description:
+            parts.append(f"توضیحات: {description[:260]}")
+    image_urls = leading_image_urls(product, 2)
+    if image_urls:
+        parts.append(f"عکس‌ها: {', '.join(image_urls)}")
+    if product.page_url:
+        parts.append(f"لینک: {product.page_url}")
+    line = " | ".join(parts)
+    bounded_put(_PRODUCT_LINE_CACHE, key, line, _PRODUCT_LINE_CACHE_MAX)
+    return line
 
 
 def build_llm_messages(
@@ -3447,10 +3724,10 @@ def build_llm_messages(
 
     prompt_parts = [base_prompt]
     if message.text:
-        lowered = message.text.lower()
-        if any(keyword in lowered for keyword in SALES_KEYWORDS):
+        topics = _PROMPT_TOPIC_CLASSIFIER.classify(message.text)
+        if "sales" in topics:
             prompt_parts.append(load_prompt("sales.txt"))
-        if any(keyword in lowered for keyword in SUPPORT_KEYWORDS):
+        if "support" in topics:
             prompt_parts.append(load_prompt("support.txt"))
 
     from app.services.context_bundle import build_context_bundle
@@ -3477,61 +3754,7 @@ def build_llm_messages(
                 messages.append({"role": "system", "content": note})
 
     if products:
-        product_lines: list[str] = []
-        for product in products:
-            title = product.title or product.slug or "بدون عنوان"
-            price = str(product.price) if product.price is not None else "نامشخص"
-            old_price = (
-                str(product.old_price) if product.old_price is not None else None
-            )
-            availability = (
-                product.availability.value
-                if hasattr(product.availability, "value")
-                else str(product.availability)
-            )
-            product_tags = infer_tags(
-                " ".join(
-                    part
-                    for part in [
-                        product.slug,
-                        product.title,
-                        product.description,
-                        product.product_id,
-                    ]
-                    if part
-                )
-            )
-            parts = [title, f"قیمت: {price}"]
-            if old_price:
-                parts.append(f"قبل: {old_price}")
-            parts.append(f"موجودی: {availability}")
-            if product.product_id:
-                parts.append(f"مدل: {product.product_id}")
-            if product_tags.categories:
-                parts.append(f"دسته: {', '.join(product_tags.categories)}")
-            if product_tags.genders:
-                parts.append(f"جنسیت: {', '.join(product_tags.genders)}")
-            if product_tags.materials:
-                parts.append(f"جنس: {', '.join(product_tags.materials)}")
-            if product_tags.styles:
-                parts.append(f"سبک: {', '.join(product_tags.styles)}")
-            if product_tags.colors:
-                parts.append(f"رنگ: {', '.join(product_tags.colors[:3])}")
-            if product.description:
-                description = " ".join(product.description.split())
-                if description:
-                    parts.append(f"توضیحات: {description[:260]}")
-            if isinstance(product.images, list):
-                image_urls = [
-                    str(item).strip()
-                    for item in product.images
-                    if isinstance(item, str) and str(item).strip()
-                ]
-                if image_urls:
-                    parts.append(f"عکس‌ها: {', '.join(image_urls[:2])}")
-            if product.page_url:
-                parts.append(f"لینک: {product.page_url}")
-            product_lines.append(" | ".join(parts))
+        product_lines = [_product_context_line(product) for product in products]
         product_context = (
             "[PRODUCTS]\n"
             + "\n".join(f"- {line}" for line in product_lines)
@@ -3547,7 +3770,7 @@ def build_llm_messages(
         messages.append({"role": "system", "content": product_context})
 
     for item in history:
-        if item.role not in {"user", "assistant"}:
+        if item.role not in _CHAT_ROLES:
             continue
         if item.type == "read":
             continue
@@ -3579,7 +3802,12 @@ async def generate_with_fallback(
     raise LLMError(f"All providers failed: {last_error}")
 
 
-async def record_usage(session: AsyncSession, usage: dict | None, provider: str) -> None:
+async def record_usage(
+    session: AsyncSession,
+    usage: dict | None,
+    provider: str,
+    commit: bool = True,
+) -> None:
     tokens_in = usage.get("prompt_tokens") if usage else None
     tokens_out = usage.get("completion_tokens") if usage else None
     record = Usage(
@@ -3590,26 +3818,130 @@ async def record_usage(session: AsyncSession, usage: dict | None, provider: str)
         cost_estimate=None,
     )
     session.add(record)
-    await session.commit()
+    if commit:
+        await session.commit()
 
 
-async def within_window(session: AsyncSession, conversation_id: int) -> bool:
-    conversation = await session.get(Conversation, conversation_id)
+def _window_open(conversation: Conversation | None) -> bool:
     if not conversation or not conversation.last_user_message_at:
         return False
     delta = utc_now() - conversation.last_user_message_at
     return delta.total_seconds() <= settings.WINDOW_HOURS * 3600
 
 
+async def within_window(session: AsyncSession, conversation_id: int) -> bool:
+    return _window_open(await session.get(Conversation, conversation_id))
+
+
 async def send_and_store(
     session: AsyncSession,
     conversation_id: int,
     receiver_id: str,
     text: str,
     meta: dict | None = None,
+    state: ConversationState | None = None,
 ) -> None:
     plan = plan_outbound(text)
-    await send_plan_and_store(session, conversation_id, receiver_id, plan, meta=meta)
+    await send_plan_and_store(
+        session, conversation_id, receiver_id, plan, meta=meta, state=state
+    )
+
+
+def _clean_quick_replies(options: list[QuickReplyOption]) -> list[QuickReplyOption]:
+    cleaned_replies = []
+    title_max = settings.QUICK_REPLY_TITLE_MAX_CHARS
+    payload_max = settings.QUICK_REPLY_PAYLOAD_MAX_CHARS
+    for option in options[: settings.MAX_QUICK_REPLIES]:
+        option.title = option.title[:title_max].strip()
+        option.payload = option.payload[:payload_max].strip()
+        if not option.title or not option.payload:
+            continue
+        cleaned_replies.append(option)
+    return cleaned_replies
+
+
+def _response_meta(
+    receiver_id: str,
+    conversation_id: int,
+    message_type: str,
+    message_id: str | None,
+    guardrail_reasons: list[str],
+    meta: dict | None,
+) -> dict[str, Any]:
+    # guardrail_reasons is the fresh list from validate_reply_or_rewrite and is
+    # not touched afterwards, so it is logged without a copy.
+    return {
+        "receiver_id": receiver_id,
+        "conversation_id": conversation_id,
+        "message_type": message_type,
+        "message_id": message_id,
+        "source": "unspecified",
+        **({"guardrail_reasons": guardrail_reasons} if guardrail_reasons else {}),
+        **(meta or {}),
+    }
+
+
+async def _send_quick_reply_followup(
+    session: AsyncSession,
+    conversation_id: int,
+    receiver_id: str,
+    plan: OutboundPlan,
+    meta: dict | None,
+    sender: Sender,
+) -> Message | None:
+    # Quick replies on a non-quick_reply plan go out as a second message. Its
+    # text already went through the guardrails with the main plan, so only the
+    # options are cleaned; the caller stores the row in the same commit.
+    quick_replies = _clean_quick_replies(plan.quick_replies)
+    if not quick_replies:
+        return None
+    follow_plan = OutboundPlan(
+        type="quick_reply",
+        text=plan.text or "کدوم گزینه مدنظر شماست؟",
+        quick_replies=quick_replies,
+    )
+    try:
+        message_id = (await sender.send_plan(receiver_id, follow_plan)).get("message_id")
+    except SenderError as exc:
+        logger.error("errors", stage="send", error=str(exc))
+        # Counted by the health check, so it must not be dropped by the sink.
+        await log_event(
+            session,
+            level="error",
+            event_type="send_error",
+            message=str(exc),
+            data={"receiver_id": receiver_id, "message_type": follow_plan.type},
+            commit=False,
+        )
+        return None
+    logger.info("outbound_sent", message_type=follow_plan.type, message_id=message_id)
+    emit_event(
+        level="info",
+        event_type="outbound_sent",
+        message=follow_plan.text,
+        data={
+            "receiver_id": receiver_id,
+            "message_type": follow_plan.type,
+            "message_id": message_id,
+        },
+    )
+    await log_event(
+        session,
+        level="info",
+        event_type="assistant_response",
+        message=follow_plan.text,
+        data=_response_meta(
+            receiver_id, conversation_id, follow_plan.type, message_id, [], meta
+        ),
+        commit=False,
+    )
+    return Message(
+        conversation_id=conversation_id,
+        role="assistant",
+        type=follow_plan.type,
+        content_text=follow_plan.text,
+        payload_json=follow_plan.model_dump(),
+    )
 
 
 async def send_plan_and_store(
@@ -3618,37 +3950,42 @@ async def send_plan_and_store(
     receiver_id: str,
     plan: OutboundPlan,
     meta: dict | None = None,
+    state: ConversationState | None = None,
+    commit: bool = True,
 ) -> str | None:
-    def _plan_to_text(value: OutboundPlan) -> str:
-        if value.text:
-            return value.text
-        if value.type == "generic_template":
-            lines = []
-            for element in value.elements:
-                line = element.title
-                if element.subtitle:
-                    line = f"{line} - {element.subtitle}"
-                lines.append(line)
-            if lines:
-                return "\n".join(lines)
-        return fallback_for_message_type("text")
-
-    if not await within_window(session, conversation_id):
-        logger.info(
-            "window_expired",
-            receiver_id=receiver_id,
-            conversation_id=conversation_id,
+    # Every console log line of a send carries these; bind them once.
+    with bound_contextvars(receiver_id=receiver_id, conversation_id=conversation_id):
+        return await _send_plan_and_store(
+            session, conversation_id, receiver_id, plan, meta, state, commit
         )
-        await log_event(
-            session,
+
+
+async def _send_plan_and_store(
+    session: AsyncSession,
+    conversation_id: int,
+    receiver_id: str,
+    plan: OutboundPlan,
+    meta: dict | None,
+    state: ConversationState | None,
+    commit: bool,
+) -> str | None:
+    # Served from the identity map when the caller already loaded the row;
+    # reused below to stamp last_bot_message_at.
+    conversation = await session.get(Conversation, conversation_id)
+    if not _window_open(conversation):
+        logger.info("window_expired")
+        emit_event(
             level="info",
             event_type="window_expired",
             message="24h window expired",
             data={"receiver_id": receiver_id, "conversation_id": conversation_id},
         )
+        # Writes the caller staged for this reply still go out.
+        if commit:
+            await session.commit()
         return None
 
-    if plan.type in {"text", "button", "quick_reply"} and not plan.text:
+    if plan.type in _TEXT_PLAN_TYPES and not plan.text:
         plan.text = fallback_for_message_type("text")
     if plan.type == "generic_template" and not plan.elements:
         plan.type = "text"
@@ -3674,26 +4011,20 @@ async def send_plan_and_store(
             plan.type = "text"
             plan.text = plan.text or fallback_for_message_type("text")
     if plan.type == "quick_reply":
-        cleaned_replies = []
-        for option in plan.quick_replies[: settings.MAX_QUICK_REPLIES]:
-            option.title = option.title[: settings.QUICK_REPLY_TITLE_MAX_CHARS].strip()
-            option.payload = option.payload[: settings.QUICK_REPLY_PAYLOAD_MAX_CHARS].strip()
-            if not option.title or not option.payload:
-                continue
-            cleaned_replies.append(option)
-        plan.quick_replies = cleaned_replies
+        plan.quick_replies = _clean_quick_replies(plan.quick_replies)
         if not plan.quick_replies:
             plan.type = "text"
             plan.text = plan.text or fallback_for_message_type("text")
     if plan.type == "generic_template":
         cleaned_elements = []
+        max_buttons = settings.MAX_BUTTONS
         for element in plan.elements[: settings.MAX_TEMPLATE_SLIDES]:
             element.title = element.title[:80].strip()
             if not element.title:
                 continue
             if element.subtitle:
                 element.subtitle = element.subtitle[:80].strip()
-            element.buttons = element.buttons[: settings.MAX_BUTTONS]
+            element.buttons = element.buttons[:max_buttons]
             cleaned_elements.append(element)
         plan.elements = cleaned_elements
         if not plan.elements:
@@ -3702,15 +4033,16 @@ async def send_plan_and_store(
 
     guardrail_reasons: list[str] = []
     if conversation_id:
-        state = await get_or_create_state(session, conversation_id)
+        # The handler passes the row it already loaded for this turn.
+        state = state or await get_or_create_state(session, conversation_id)
         state_payload = build_state_payload(state)
         required_slots = (
             state.slots_required if isinstance(state.slots_required, list) else []
         )
         allow_generic_slots = bool(
             state.intent == "product_search"
-            and state.category in {"shoes", "apparel"}
-            and any(slot in {"gender", "size", "style", "budget"} for slot in required_slots)
+            and state.category in _GENERIC_SLOT_CATEGORIES
+            and any(slot in _GENERIC_SLOT_FIELDS for slot in required_slots)
         )
         has_products_context = bool(
             meta
@@ -3743,50 +4075,18 @@ async def send_plan_and_store(
                 },
                 commit=False,
             )
-            for reason in guardrail_reasons:
-                if reason.startswith("template_blocked"):
-                    await log_event(
-                        session,
-                        level="info",
-                        event_type="template_blocked",
-                        data={
-                            "conversation_id": conversation_id,
-                            "receiver_id": receiver_id,
-                            "reason": reason,
-                        },
-                        commit=False,
-                    )
-                elif reason.startswith("hallucination_prevented"):
-                    await log_event(
-                        session,
-                        level="info",
-                        event_type="hallucination_prevented",
-                        data={
-                            "conversation_id": conversation_id,
-                            "receiver_id": receiver_id,
-                            "reason": reason,
-                        },
-                        commit=False,
-                    )
-                elif reason.startswith("link_request"):
-                    await log_event(
-                        session,
-                        level="info",
-                        event_type="link_request_handled",
-                        data={
-                            "conversation_id": conversation_id,
-                            "receiver_id": receiver_id,
-                            "reason": reason,
-                        },
-                        commit=False,
-                    )
-            await session.commit()
+            _emit_guardrail_reason_events(
+                _classify_guardrail_reasons(guardrail_reasons)[1],
+                {"conversation_id": conversation_id, "receiver_id": receiver_id},
+            )
 
     if plan.text:
         plan.text = plan.text[: settings.MAX_RESPONSE_CHARS].strip()
 
-    await log_event(
-        session,
+    # reply_planned and outbound_sent are diagnostics nothing reads back;
+    # assistant_response and send_error stay in the turn's transaction because
+    # the next turn's prompt summary and the health check read them.
+    emit_event(
         level="info",
         event_type="reply_planned",
         data={
@@ -3796,42 +4096,22 @@ async def send_plan_and_store(
             "intent": meta.get("intent") if meta else None,
             "store_topic": meta.get("store_topic") if meta else None,
         },
-        commit=False,
     )
 
-    sender = Sender()
+    sender = get_sender()
+    # No DB round trip is left to overlap with the send: the conversation and
+    # state were loaded above (the guardrails need them before sending), and
+    # after it everything is staged in memory until the single commit.
+    # Text form of what went out; set by the text fallback, otherwise derived
+    # from the plan only when a bot action needs it.
+    sent_text: str | None = None
+    follow_record: Message | None = None
 
     try:
-        response_data = None
-        if plan.type == "button":
-            response_data = await sender.send_button_text(
-                receiver_id, plan.text or "", plan.buttons
-            )
-        elif plan.type == "quick_reply":
-            response_data = await sender.send_quick_reply(
-                receiver_id, plan.text or "", plan.quick_replies
-            )
-        elif plan.type == "generic_template":
-            response_data = await sender.send_generic_template(receiver_id, plan.elements)
-        elif plan.type == "photo":
-            response_data = await sender.send_photo(receiver_id, plan.image_url or "")
-        elif plan.type == "video":
-            response_data = await sender.send_video(receiver_id, plan.video_url or "")
-        elif plan.type == "audio":
-            response_data = await sender.send_audio(receiver_id, plan.audio_url or "")
-        else:
-            response_data = await sender.send_text(receiver_id, plan.text or "")
-        message_id = None
-        if isinstance(response_data, dict):
-            message_id = response_data.get("message_id")
-        logger.info(
-            "outbound_sent",
-            receiver_id=receiver_id,
-            message_type=plan.type,
-            message_id=message_id,
-        )
-        await log_event(
-            session,
+        # Sender._post only returns JSON objects with success=True.
+        message_id = (await sender.send_plan(receiver_id, plan)).get("message_id")
+        logger.info("outbound_sent", message_type=plan.type, message_id=message_id)
+        emit_event(
             level="info",
             event_type="outbound_sent",
             message=plan.text,
@@ -3840,19 +4120,10 @@ async def send_plan_and_store(
                 "message_type": plan.type,
                 "message_id": message_id,
             },
-            commit=False,
         )
-        response_meta = {
-            "receiver_id": receiver_id,
-            "conversation_id": conversation_id,
-            "message_type": plan.type,
-            "message_id": message_id,
-            "source": "unspecified",
-        }
-        if guardrail_reasons:
-            response_meta["guardrail_reasons"] = list(guardrail_reasons)
-        if meta:
-            response_meta.update(meta)
+        response_meta = _response_meta(
+            receiver_id, conversation_id, plan.type, message_id, guardrail_reasons, meta
+        )
         await log_event(
             session,
             level="info",
@@ -3862,46 +4133,35 @@ async def send_plan_and_store(
             commit=False,
         )
         if plan.quick_replies and plan.type != "quick_reply":
-            follow_text = plan.text or "کدوم گزینه مدنظر شماست؟"
-            follow_plan = OutboundPlan(
-                type="quick_reply",
-                text=follow_text,
-                quick_replies=plan.quick_replies,
-            )
-            await send_plan_and_store(
-                session,
-                conversation_id,
-                receiver_id,
-                follow_plan,
-                meta=meta,
+            follow_record = await _send_quick_reply_followup(
+                session, conversation_id, receiver_id, plan, meta, sender
             )
     except SenderError as exc:
         logger.error("errors", stage="send", error=str(exc))
+        # Counted by the health check, so it must not be dropped by the sink.
         await log_event(
             session,
             level="error",
             event_type="send_error",
             message=str(exc),
             data={"receiver_id": receiver_id, "message_type": plan.type},
+            commit=False,
         )
-        if plan.type == "text":
-            return None
-        fallback_text = _plan_to_text(plan)
-        try:
-            response_data = await sender.send_text(receiver_id, fallback_text)
-        except SenderError:
+        fallback_text = None if plan.type == "text" else _plan_to_text(plan)
+        response_data = None
+        if fallback_text:
+            try:
+                response_data = await sender.send_text(receiver_id, fallback_text)
+            except SenderError:
+                pass
+        if response_data is None:
+            if commit:
+                # Keep what the turn staged so far even though nothing was sent.
+                await session.commit()
             return None
-        message_id = None
-        if isinstance(response_data, dict):
-            message_id = response_data.get("message_id")
-        logger.info(
-            "outbound_sent",
-            receiver_id=receiver_id,
-            message_type="text_fallback",
-            message_id=message_id,
-        )
-        await log_event(
-            session,
+        message_id = response_data.get("message_id")
+        logger.info("outbound_sent", message_type="text_fallback", message_id=message_id)
+        emit_event(
             level="info",
             event_type="outbound_sent",
             message=fallback_text,
@@ -3910,19 +4170,10 @@ async def send_plan_and_store(
                 "message_type": "text_fallback",
                 "message_id": message_id,
             },
-            commit=False,
         )
-        response_meta = {
-            "receiver_id": receiver_id,
-            "conversation_id": conversation_id,
-            "message_type": "text_fallback",
-            "message_id": message_id,
-            "source": "unspecified",
-        }
-        if guardrail_reasons:
-            response_meta["guardrail_reasons"] = list(guardrail_reasons)
-        if meta:
-            response_meta.update(meta)
+        response_meta = _response_meta(
+            receiver_id, conversation_id, "text_fallback", message_id, guardrail_reasons, meta
+        )
         await log_event(
             session,
             level="info",
@@ -3931,11 +4182,13 @@ async def send_plan_and_store(
             data=response_meta,
             commit=False,
         )
-        plan = OutboundPlan(type="text", text=fallback_text)
+        # Only read back for the stored row; both fields are already known good.
+        plan = OutboundPlan.model_construct(type="text", text=fallback_text)
+        sent_text = fallback_text
 
-    conversation = await session.get(Conversation, conversation_id)
-    if conversation:
-        conversation.last_bot_message_at = utc_now()
+    # Loaded for the window check above, so this is just the column write
+    # that goes out with the commit's flush.
+    conversation.last_bot_message_at = utc_now()
 
     record = Message(
         conversation_id=conversation_id,
@@ -3946,7 +4199,8 @@ async def send_plan_and_store(
         payload_json=plan.model_dump(),
     )
     session.add(record)
-    await session.commit()
+    if follow_record is not None:
+        session.add(follow_record)
     action_key = None
     handler_used = None
     if meta and meta.get("intent"):
@@ -3960,7 +4214,13 @@ async def send_plan_and_store(
             session,
             conversation_id,
             action_key,
-            _plan_to_text(plan),
+            sent_text or _plan_to_text(plan),
             handler_used=handler_used,
+            # Reusing the loaded state avoids a SELECT whose autoflush would
+            # split this send's writes across two flushes.
+            state=state,
+            commit=False,
         )
+    if commit:
+        await session.commit()
     return message_id
@@ -15,10 +15,12 @@ from app.services.product_taxonomy import (
     MATERIAL_SYNONYMS,
     SIZE_KEYWORDS,
     STYLE_SYNONYMS,
+    TagInfo,
     expand_query_terms,
     infer_tags,
     match_brands,
 )
+from app.utils.cache import bounded_put, row_version_key
 
 _TOKEN_RE = re.compile(r"[\w\u0600-\u06FF]+", re.UNICODE)
 _STOPWORDS = {
@@ -59,6 +61,31 @@ _IGNORE_TOKENS.update({keyword.lower() for keyword in COLOR_KEYWORDS})
 _IGNORE_TOKENS.update({keyword.lower() for keyword in SIZE_KEYWORDS})
 
 
+_PRODUCT_TAGS_CACHE_MAX = 4096
+# (product id, updated_at) -> tags inferred from its text.
+_PRODUCT_TAGS_CACHE: dict[tuple[int, datetime | None], TagInfo] = {}
+
+
+def product_tag_info(product: Product) -> TagInfo:
+    key = row_version_key(product)
+    tags = _PRODUCT_TAGS_CACHE.get(key)
+    if tags is None:
+        tags = infer_tags(
+            " ".join(
+                part
+                for part in [
+                    product.slug,
+                    product.title,
+                    product.description,
+                    product.product_id,
+                ]
+                if part
+            )
+        )
+        bounded_put(_PRODUCT_TAGS_CACHE, key, tags, _PRODUCT_TAGS_CACHE_MAX)
+    return tags
+
+
 def _content_tokens(tokens: list[str]) -> list[str]:
     return [token for token in tokens if token not in _IGNORE_TOKENS]
 
@@ -224,7 +251,7 @@ async def match_products_with_scores(
             ]
             if part
         )
-        product_tags = infer_tags(product_text)
+        product_tags = product_tag_info(product)
         product_brands = match_brands(product_text)
         if query_tags.categories and not set(query_tags.categories).intersection(
             product_tags.categories
@@ -126,6 +126,23 @@ def _normalize_images(value: object | None) -> list[str]:
     return []
 
 
+def leading_image_urls(product: Product, limit: int) -> list[str]:
+    # Only the first few plain-string URLs, without normalizing the whole list.
+    images = product.images
+    if not isinstance(images, list):
+        return []
+    urls: list[str] = []
+    for item in images:
+        if not isinstance(item, str):
+            continue
+        url = item.strip()
+        if url:
+            urls.append(url)
+            if len(urls) >= limit:
+                break
+    return urls
+
+
 def _build_product_buttons(product: Product) -> list[Button]:
     buttons: list[Button] = []
     product_url = _build_product_url(product)
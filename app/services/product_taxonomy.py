@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from functools import lru_cache
 import re
 
 
@@ -568,6 +569,9 @@ def match_brands(text: str | None) -> list[str]:
     return matches
 
 
+# TagInfo is immutable, so the routing, state and matching passes of one turn
+# can share a single inference per text.
+@lru_cache(maxsize=1024)
 def infer_tags(text: str | None) -> TagInfo:
     normalized = _normalize_text(text)
     if not normalized:
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+from typing import Awaitable, Callable
+
 import structlog
 import httpx
 
 from app.core.config import settings
-from app.schemas.send import Button, QuickReplyOption, TemplateElement
+from app.schemas.send import Button, OutboundPlan, QuickReplyOption, TemplateElement
 
 logger = structlog.get_logger(__name__)
 
@@ -19,6 +21,19 @@ class Sender:
         self.send_prefix = settings.DIRECTAM_SEND_PREFIX.strip("/")
         self.api_token = settings.SERVICE_API_KEY
         self.headers = self._auth_headers()
+        self._client: httpx.AsyncClient | None = None
+
+    def _http_client(self) -> httpx.AsyncClient:
+        # Kept open so consecutive sends reuse pooled keep-alive connections
+        # instead of paying a new TCP/TLS handshake each time.
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=settings.REQUEST_TIMEOUT_SEC)
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     def _auth_headers(self) -> dict[str, str]:
         token = self.api_token
@@ -113,6 +128,12 @@ class Sender:
             },
         )
 
+    async def send_plan(self, receiver_id: str, plan: OutboundPlan) -> dict:
+        send = _PLAN_SENDERS.get(plan.type)
+        if send is None:
+            return await self.send_text(receiver_id, plan.text or "")
+        return await send(self, receiver_id, plan)
+
     def _with_api_token(self, payload: dict) -> dict:
         data = dict(payload)
         if not data.get("api_token"):
@@ -128,13 +149,12 @@ class Sender:
         payload = self._with_api_token(payload)
         params = {"api_token": self.api_token}
         try:
-            async with httpx.AsyncClient(timeout=settings.REQUEST_TIMEOUT_SEC) as client:
-                response = await client.post(
-                    url,
-                    json=payload,
-                    headers=self.headers,
-                    params=params,
-                )
+            response = await self._http_client().post(
+                url,
+                json=payload,
+                headers=self.headers,
+                params=params,
+            )
         except httpx.HTTPError as exc:
             logger.error("errors", stage="send_http", path=path, error=str(exc))
             raise SenderError(f"Send failed: {exc}") from exc
@@ -168,3 +188,40 @@ class Sender:
             raise SenderError(f"Send failed: {data}")
 
         return data
+
+
+# plan.type -> send call; anything else goes out as plain text.
+_PLAN_SENDERS: dict[str, Callable[[Sender, str, OutboundPlan], Awaitable[dict]]] = {
+    "button": lambda sender, receiver_id, plan: sender.send_button_text(
+        receiver_id, plan.text or "", plan.buttons
+    ),
+    "quick_reply": lambda sender, receiver_id, plan: sender.send_quick_reply(
+        receiver_id, plan.text or "", plan.quick_replies
+    ),
+    "generic_template": lambda sender, receiver_id, plan: sender.send_generic_template(
+        receiver_id, plan.elements
+    ),
+    "photo": lambda sender, receiver_id, plan: sender.send_photo(
+        receiver_id, plan.image_url or ""
+    ),
+    "video": lambda sender, receiver_id, plan: sender.send_video(
+        receiver_id, plan.video_url or ""
+    ),
+    "audio": lambda sender, receiver_id, plan: sender.send_audio(
+        receiver_id, plan.audio_url or ""
+    ),
+}
+
+_SENDER: Sender | None = None
+
+
+def get_sender() -> Sender:
+    global _SENDER
+    if _SENDER is None:
+        _SENDER = Sender()
+    return _SENDER
+
+
+async def close_sender() -> None:
+    if _SENDER is not None:
+        await _SENDER.aclose()
@@ -20,6 +20,7 @@ async def upsert_behavior_profile(
     last_message: str | None,
     summary_counts: dict[str, int] | None = None,
     recent_payload: list[dict[str, Any]] | None = None,
+    commit: bool = True,
 ) -> UserBehaviorProfile:
     profile = await session.get(UserBehaviorProfile, user_id)
     if not profile:
@@ -68,7 +69,8 @@ async def upsert_behavior_profile(
             )
         )
 
-    await session.commit()
+    if commit:
+        await session.commit()
     return profile
 
 
@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any, Hashable, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+def bounded_put(cache: dict[K, V], key: K, value: V, max_size: int) -> None:
+    # Dicts keep insertion order, so the first key is the oldest entry; evict
+    # from the front until there is room. Re-putting a key moves it to the back.
+    cache.pop(key, None)
+    while cache and len(cache) >= max_size:
+        cache.pop(next(iter(cache)))
+    cache[key] = value
+
+
+def row_version_key(row: Any) -> tuple[int, datetime | None]:
+    # Every edit bumps updated_at, so (id, updated_at) names one version of a
+    # row; entries for older versions are simply never looked up again and
+    # age out through the size bound.
+    return (row.id, row.updated_at)
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+import re
+from typing import Callable, Generic, Hashable, Iterable, Mapping, TypeVar
+
+T = TypeVar("T", bound=Hashable)
+
+
+class KeywordClassifier(Generic[T]):
+    # Tags every keyword group whose keywords occur as substrings of a text,
+    # using one compiled regex scan instead of a Python loop per group. Tags
+    # can be any hashable key, e.g. strings or list indexes.
+
+    def __init__(
+        self,
+        groups: Mapping[T, Iterable[str]],
+        normalize: Callable[[str], str] | None = None,
+    ) -> None:
+        self._normalize = normalize or str.lower
+        tags_by_keyword: dict[str, set[T]] = {}
+        for tag, keywords in groups.items():
+            for keyword in keywords:
+                cleaned = self._normalize(keyword)
+                if cleaned:
+                    tags_by_keyword.setdefault(cleaned, set()).add(tag)
+        ordered = sorted(tags_by_keyword, key=len, reverse=True)
+        # The scan reports the longest keyword starting at each position, so a
+        # hit also carries the tags of every shorter keyword that prefixes it.
+        self._tags: dict[str, frozenset[T]] = {
+            keyword: frozenset(
+                tag
+                for other in ordered
+                if keyword.startswith(other)
+                for tag in tags_by_keyword[other]
+            )
+            for keyword in ordered
+        }
+        self._pattern = (
+            re.compile("(?=(" + "|".join(map(re.escape, ordered)) + "))")
+            if ordered
+            else None
+        )
+
+    def classify(self, text: str | None, *, normalized: bool = False) -> frozenset[T]:
+        if not text or self._pattern is None:
+            return frozenset()
+        value = text if normalized else self._normalize(text)
+        hits: set[T] = set()
+        for match in self._pattern.finditer(value):
+            hits |= self._tags[match.group(1)]
+        return frozenset(hits)
@@ -17,9 +17,11 @@ def parse_timestamp(value: Any) -> datetime | None:
             timestamp = timestamp / 1000.0
         return datetime.fromtimestamp(timestamp, tz=timezone.utc)
     if isinstance(value, str):
-        cleaned = value.replace("Z", "+00:00")
+        # fromisoformat only accepts a trailing "Z" from Python 3.11 on.
+        if value.endswith("Z"):
+            value = value[:-1] + "+00:00"
         try:
-            parsed = datetime.fromisoformat(cleaned)
+            parsed = datetime.fromisoformat(value)
         except ValueError:
             return None
         if parsed.tzinfo is None:
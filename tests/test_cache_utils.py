@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+from app.utils.cache import bounded_put, row_version_key
+
+
+def test_bounded_put_evicts_oldest_entries_first() -> None:
+    cache: dict[str, int] = {}
+    for index, key in enumerate("abc"):
+        bounded_put(cache, key, index, 3)
+    bounded_put(cache, "a", 10, 3)
+    bounded_put(cache, "d", 3, 3)
+
+    assert list(cache.items()) == [("c", 2), ("a", 10), ("d", 3)]
+
+
+def test_row_version_key_changes_with_updated_at() -> None:
+    row = SimpleNamespace(id=4, updated_at=1)
+    first = row_version_key(row)
+    row.updated_at = 2
+
+    assert row_version_key(row) != first
+    assert row_version_key(row) == (4, 2)
@@ -110,3 +110,31 @@ def test_update_state_keeps_order_flow_with_selected_product() -> None:
     )
 
     assert updated.intent == "order_flow"
+
+
+def test_update_state_keeps_timestamp_when_unchanged() -> None:
+    class _SessionStub:
+        async def commit(self) -> None:
+            return None
+
+    state = ConversationState(conversation_id=1)
+    session = _SessionStub()
+
+    def _touch() -> ConversationState:
+        return asyncio.run(
+            update_state(
+                session,
+                conversation_id=1,
+                intent="browse_products",
+                category="shoes",
+                slots_required=None,
+                slots_filled={"size": "42"},
+                last_user_question="کفش",
+                state=state,
+                last_user_message_id=5,
+            )
+        )
+
+    first = _touch().updated_at
+    assert first is not None
+    assert _touch().updated_at is first
@@ -0,0 +1,22 @@
+from datetime import datetime, timezone
+
+from app.utils.time import parse_timestamp
+
+
+def test_parse_timestamp_accepts_trailing_z() -> None:
+    assert parse_timestamp("2026-01-05T10:30:00Z") == datetime(
+        2026, 1, 5, 10, 30, tzinfo=timezone.utc
+    )
+    assert parse_timestamp("2026-01-05T10:30:00.250Z") == datetime(
+        2026, 1, 5, 10, 30, 0, 250000, tzinfo=timezone.utc
+    )
+
+
+def test_parse_timestamp_normalizes_offsets_and_rejects_garbage() -> None:
+    assert parse_timestamp("2026-01-05T14:00:00+03:30") == datetime(
+        2026, 1, 5, 10, 30, tzinfo=timezone.utc
+    )
+    assert parse_timestamp("2026-01-05T10:30:00") == datetime(
+        2026, 1, 5, 10, 30, tzinfo=timezone.utc
+    )
+    assert parse_timestamp("not a date") is None